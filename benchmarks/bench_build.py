@@ -0,0 +1,253 @@
+"""Benchmarks the platter build pipeline on generated projects without
+network access.
+
+    $ python benchmarks/bench_build.py --seed-wheelhouse SEED
+
+The seed wheelhouse needs to contain the distributions that platter
+itself needs to build a package (virtualenv, wheel, setuptools and pip).
+It can be created once with::
+
+    $ pip download -d SEED virtualenv wheel setuptools pip
+
+Three projects are generated: a pure Python application, an application
+with many small dependencies (generated as wheels into a local
+wheelhouse) and an application with a C extension.  Each of them is
+built for every supported format, first with a cold and then with a
+warm cache, and the artifact is installed with the generated install
+script.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import zipfile
+import tempfile
+import subprocess
+
+import click
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import platter
+
+
+class QuietLog(platter.Log):
+
+    def echo(self, s):
+        pass
+
+    def echo_lines(self, lines, color=None):
+        pass
+
+
+SETUP_PY = '''\
+from setuptools import setup%(imports)s
+setup(
+    name=%(name)r,
+    version='1.0',
+    packages=[%(name)r],
+    install_requires=%(requires)r,%(extra)s
+)
+'''
+
+C_EXTENSION = '''\
+#include <Python.h>
+
+static PyObject *add(PyObject *self, PyObject *args)
+{
+    long a, b;
+    if (!PyArg_ParseTuple(args, "ll", &a, &b))
+        return NULL;
+    return PyLong_FromLong(a + b);
+}
+
+static PyMethodDef methods[] = {
+    {"add", add, METH_VARARGS, NULL},
+    {NULL, NULL, 0, NULL}
+};
+
+#if PY_MAJOR_VERSION >= 3
+static struct PyModuleDef module = {
+    PyModuleDef_HEAD_INIT, "_speedups", NULL, -1, methods
+};
+PyMODINIT_FUNC PyInit__speedups(void) { return PyModule_Create(&module); }
+#else
+PyMODINIT_FUNC init_speedups(void) { Py_InitModule("_speedups", methods); }
+#endif
+'''
+
+
+def make_project(base, name, requires=(), c_extension=False):
+    path = os.path.join(base, name)
+    os.makedirs(os.path.join(path, name))
+    imports = extra = ''
+    if c_extension:
+        imports = ', Extension'
+        extra = '\n    ext_modules=[Extension(%r, [%r])],' % (
+            name + '._speedups', name + '/_speedups.c')
+        with open(os.path.join(path, name, '_speedups.c'), 'w') as f:
+            f.write(C_EXTENSION)
+    with open(os.path.join(path, 'setup.py'), 'w') as f:
+        f.write(SETUP_PY % {'name': name, 'requires': list(requires),
+                            'imports': imports, 'extra': extra})
+    with open(os.path.join(path, name, '__init__.py'), 'w') as f:
+        f.write('VALUE = %r\n' % name)
+    return path
+
+
+def make_wheel(wheelhouse, name, version='1.0'):
+    """Writes a minimal pure Python wheel without invoking pip."""
+    dist_info = '%s-%s.dist-info' % (name, version)
+    files = {
+        '%s/__init__.py' % name: 'VALUE = %r\n' % name,
+        dist_info + '/METADATA': 'Metadata-Version: 2.1\nName: %s\n'
+                                 'Version: %s\n' % (name, version),
+        dist_info + '/WHEEL': 'Wheel-Version: 1.0\nGenerator: platter-bench'
+                              '\nRoot-Is-Purelib: true\nTag: py2-none-any\n'
+                              'Tag: py3-none-any\n',
+        dist_info + '/top_level.txt': name + '\n',
+    }
+    record = []
+    for filename, contents in sorted(files.items()):
+        digest = hashlib.sha256(contents).digest().encode('base64')
+        record.append('%s,sha256=%s,%d' % (
+            filename, digest.strip().rstrip('=').replace('+', '-')
+            .replace('/', '_'), len(contents)))
+    record.append(dist_info + '/RECORD,,')
+    files[dist_info + '/RECORD'] = '\n'.join(record) + '\n'
+
+    fn = os.path.join(wheelhouse, '%s-%s-py2.py3-none-any.whl' %
+                      (name, version))
+    with zipfile.ZipFile(fn, 'w', zipfile.ZIP_DEFLATED) as f:
+        for filename, contents in sorted(files.items()):
+            f.writestr(filename, contents)
+
+
+def make_fixtures(base, wheelhouse, deps):
+    dep_names = ['benchdep%d' % idx for idx in range(deps)]
+    for name in dep_names:
+        make_wheel(wheelhouse, name)
+    return [
+        ('pure', make_project(base, 'pureapp')),
+        ('many-deps', make_project(base, 'depsapp', requires=dep_names)),
+        ('c-extension', make_project(base, 'capp', c_extension=True)),
+    ]
+
+
+def get_size(artifact):
+    if not os.path.isdir(artifact):
+        return os.path.getsize(artifact)
+    return sum(os.path.getsize(os.path.join(dirpath, x))
+               for dirpath, _, filenames in os.walk(artifact)
+               for x in filenames)
+
+
+def time_install(artifact, python, tmp):
+    target = tempfile.mkdtemp(dir=tmp)
+    try:
+        folder = platter.extract_artifact(artifact, target)
+        start = time.time()
+        rv = subprocess.call(['bash', os.path.join(folder, 'install.sh'),
+                              '-p', python, os.path.join(target, 'venv')],
+                             stdout=open(os.devnull, 'w'),
+                             stderr=subprocess.STDOUT)
+        if rv != 0:
+            return None
+        return time.time() - start
+    finally:
+        shutil.rmtree(target)
+
+
+def run_build(project, format, python, wheelhouse, cache, output,
+              virtualenv_version):
+    builder = platter.Builder(
+        QuietLog(), project, output, python=python,
+        virtualenv_version=virtualenv_version,
+        pip_options=['-f', wheelhouse], no_download=True,
+        wheel_cache=os.path.join(cache, 'wheels'),
+        venv_pool=os.path.join(cache, 'venvs'), force=True)
+    start = time.time()
+    with builder:
+        builder.build(format)
+    total = time.time() - start
+    artifacts = [os.path.join(output, x) for x in os.listdir(output)
+                 if x[:1] != '.' and not x.endswith('.fingerprint')]
+    return builder.timings, total, artifacts[0]
+
+
+@click.command()
+@click.option('--seed-wheelhouse', type=click.Path(exists=True),
+              required=True, help='A folder with virtualenv, wheel, '
+              'setuptools and pip distributions.')
+@click.option('-p', '--python', default=sys.executable,
+              help='The interpreter to build for.')
+@click.option('--virtualenv-version', help='The version of virtualenv to '
+              'use from the seed wheelhouse.')
+@click.option('--format', 'formats', multiple=True,
+              type=click.Choice(platter.FORMATS),
+              help='Only benchmark the given formats.')
+@click.option('--deps', type=int, default=50, show_default=True,
+              help='The number of dependencies of the many-deps project.')
+@click.option('--no-install', is_flag=True,
+              help='Do not measure the install time of the artifacts.')
+@click.option('--json', 'json_output', type=click.Path(),
+              help='Writes the results as JSON to the given file.')
+def cli(seed_wheelhouse, python, virtualenv_version, formats, deps,
+        no_install, json_output):
+    tmp = tempfile.mkdtemp()
+    results = []
+    try:
+        wheelhouse = os.path.join(tmp, 'wheelhouse')
+        shutil.copytree(os.path.abspath(seed_wheelhouse), wheelhouse)
+        fixtures = make_fixtures(tmp, wheelhouse, deps)
+
+        click.echo('%-12s %-8s %-5s %8s %8s %8s %10s %8s' % (
+            'project', 'format', 'cache', 'total', 'wheels', 'archive',
+            'size', 'install'))
+        for name, project in fixtures:
+            for format in formats or platter.FORMATS:
+                cache = tempfile.mkdtemp(dir=tmp)
+                for state in 'cold', 'warm':
+                    output = tempfile.mkdtemp(dir=tmp)
+                    timings, total, artifact = run_build(
+                        project, format, python, wheelhouse, cache, output,
+                        virtualenv_version)
+                    phases = dict((x['name'], x['wall'])
+                                  for x in timings.phases)
+                    install = None
+                    if not no_install:
+                        install = time_install(artifact, python, tmp)
+                    result = {
+                        'project': name,
+                        'format': format,
+                        'cache': state,
+                        'total': total,
+                        'phases': timings.phases,
+                        'processes': timings.processes,
+                        'size': get_size(artifact),
+                        'install': install,
+                    }
+                    results.append(result)
+                    click.echo('%-12s %-8s %-5s %7.2fs %7.2fs %7.2fs '
+                               '%10d %8s' % (
+                                   name, format, state, total,
+                                   phases.get('build_wheels', 0),
+                                   phases.get('create_archive', 0),
+                                   result['size'],
+                                   '-' if no_install else
+                                   'failed' if install is None
+                                   else '%.2fs' % install))
+                    shutil.rmtree(output)
+                shutil.rmtree(cache)
+    finally:
+        shutil.rmtree(tmp)
+
+    if json_output is not None:
+        with open(json_output, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,80 @@
+"""Compares the single threaded tar.gz writer with the parallel gzip
+writer that is used for ``--compress-threads``.
+
+    $ python benchmarks/bench_gzip.py [PATH] [-t THREADS ...]
+
+If no path is given a folder with generated data is archived.
+"""
+import os
+import sys
+import time
+import shutil
+import tarfile
+import tempfile
+import subprocess
+
+import click
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from platter import ParallelGzipFile
+
+
+def generate_data(path, size):
+    # Mix compressible text with random data to roughly mimic a folder
+    # full of wheels.
+    chunk = 1024 * 1024
+    for idx in range(size):
+        with open(os.path.join(path, 'file%d' % idx), 'wb') as f:
+            if idx % 2:
+                f.write(os.urandom(chunk))
+            else:
+                f.write(''.join('line %d of file %d\n' % (x, idx)
+                                for x in range(chunk // 20))[:chunk])
+
+
+def write_archive(path, fn, threads):
+    if threads == 1:
+        f = tarfile.open(fn, 'w:gz')
+        f.add(path, 'bench')
+        f.close()
+        return
+    with open(fn, 'wb') as raw:
+        gz = ParallelGzipFile(raw, threads)
+        f = tarfile.open(fileobj=gz, mode='w|')
+        f.add(path, 'bench')
+        f.close()
+        gz.close()
+
+
+@click.command()
+@click.argument('path', required=False, type=click.Path(exists=True))
+@click.option('-t', '--threads', type=int, multiple=True,
+              help='The thread counts to benchmark.')
+@click.option('--size', type=int, default=64, show_default=True,
+              help='The size of the generated data in MB.')
+@click.option('--rounds', type=int, default=3, show_default=True)
+def cli(path, threads, size, rounds):
+    tmp = tempfile.mkdtemp()
+    try:
+        if path is None:
+            path = os.path.join(tmp, 'data')
+            os.makedirs(path)
+            generate_data(path, size)
+        fn = os.path.join(tmp, 'bench.tar.gz')
+
+        for count in sorted(set((1,) + (threads or (2, 4, 8)))):
+            timings = []
+            for _ in range(rounds):
+                start = time.time()
+                write_archive(path, fn, count)
+                timings.append(time.time() - start)
+            subprocess.check_call(['tar', 'tzf', fn],
+                                  stdout=open(os.devnull, 'w'))
+            click.echo('threads=%-3d best=%.2fs size=%d' % (
+                count, min(timings), os.path.getsize(fn)))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    cli()
@@ -1,22 +1,87 @@
 import os
+import re
 import sys
+import bz2
+import cgi
+import glob
 import json
 import time
+import zlib
 import click
 import errno
+import stat
+import struct
 import shutil
 import select
+import signal
+import socket
 import tarfile
 import zipfile
 import hashlib
+import urllib
 import tempfile
+import threading
+import traceback
 import sysconfig
 import subprocess
+import SocketServer
+from collections import deque
+from email.parser import Parser
 from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 
 WIN = sys.platform.startswith('win')
-FORMATS = ['tar.gz', 'tar.bz2', 'tar', 'zip', 'dir']
+# ioctl to create a copy-on-write clone of a file on Linux (btrfs, xfs)
+FICLONE = 0x40049409
+FORMATS = ['tar.gz', 'tar.bz2']
+if lzma is not None:
+    FORMATS.append('tar.xz')
+if zstandard is not None:
+    FORMATS.append('tar.zst')
+FORMATS.extend(['tar', 'zip', 'dir'])
+COMPRESS_LEVELS = {
+    'tar.gz': (1, 9),
+    'tar.bz2': (1, 9),
+    'tar.xz': (0, 9),
+    'tar.zst': (1, 22),
+}
+IGNORED_SOURCE_DIRS = ['build', 'dist']
+LOCK_FILENAME = 'platter.lock'
+STORE_FOLDER = '.store'
+# How often pooled build virtualenvs look for a new release of wheel if
+# no version of it was requested.
+VENV_POOL_REFRESH = 24 * 60 * 60
+# Prints the implementation, version and ABI of an interpreter the way
+# wheels tag them, for instance cp27mu or cp36m.
+INTERPRETER_TAG_SCRIPT = '''\
+import sys, platform
+impl = {'CPython': 'cp', 'PyPy': 'pp'}.get(
+    platform.python_implementation(), 'py')
+flags = getattr(sys, 'abiflags', None)
+if flags is None:
+    flags = (hasattr(sys, 'gettotalrefcount') and 'd' or '') + 'm' + \\
+        (sys.maxunicode == 0x10ffff and 'u' or '')
+print('%s%d%d%s' % ((impl,) + sys.version_info[:2] + (flags,)))
+'''
 INSTALLER = '''\
 #!/bin/bash
 # This script installs the bundled wheel distribution of %(name)s into
@@ -34,11 +99,17 @@ cat << EOF
 
   Installs %(name)s into a new virtualenv that is provided as the DST
   parameter.  The interpreter to use for this virtualenv can be
-  overridden by the "-p" parameter.
+  overridden by the "-p" parameter.  If the package contains a prebuilt
+  virtualenv, it is copied to DST instead.
 
 Options:
   --help              display this help and exit.
   -p --python PYTHON  use an alternative Python interpreter
+  --fast              unpack the wheels directly instead of installing
+                      them with pip
+  --no-compile        do not compile the installed modules to bytecode
+  --unchecked-hash    compile to hash based pycs that are never checked
+                      against the source (Python 3.7 and later)
 EOF
   exit 0
 }
@@ -51,6 +122,9 @@ param_error() {
 }
 
 py="%(python)s"
+fast=0
+compile=1
+unchecked_hash=0
 
 while [[ "$#" -gt 0 ]]; do
   case $1 in
@@ -64,6 +138,9 @@ while [[ "$#" -gt 0 ]]; do
       fi
       ;;
     --python=?*)    py=${1#*=} ;;
+    --fast)         fast=1 ;;
+    --no-compile)   compile=0 ;;
+    --unchecked-hash) unchecked_hash=1 ;;
     --)             shift; break ;;
     -?*)            param_error "no such option: $1" ;;
     *)              break
@@ -82,25 +159,77 @@ DATA_DIR="$HERE/data"
 command -v "$py" &> /dev/null || \
   { echo "Given python interpreter not found ($py)" >&2; exit 1; }
 
-echo 'Setting up virtualenv'
-"$py" "$DATA_DIR/virtualenv.py" "$1"
-VIRTUAL_ENV="$(cd "$1"; pwd)"
-
-INSTALL_ARGS=''
-if [[ -f "$DATA_DIR/requirements.txt" ]]; then
-  INSTALL_ARGS="$INSTALL_ARGS"\ -r\ "$DATA_DIR/requirements.txt"
+prebuilt=0
+if [[ -d "$HERE/venv" ]]; then
+  echo 'Copying prebuilt virtualenv'
+  mkdir -p "$1"
+  cp -a "$HERE/venv/." "$1"
+  VIRTUAL_ENV="$(cd "$1"; pwd)"
+  if "$VIRTUAL_ENV/bin/python" "$DATA_DIR/relocate.py" "$VIRTUAL_ENV"; then
+    prebuilt=1
+  else
+    echo 'Prebuilt virtualenv is not usable, installing from wheels' >&2
+    rm -rf "$VIRTUAL_ENV"
+  fi
 fi
 
-echo 'Installing %(name)s'
-"$VIRTUAL_ENV/bin/pip" install --pre --no-index \
-  --find-links "$DATA_DIR" wheel $INSTALL_ARGS %(pkg)s | grep -v '^$'
-if [[ ${PIPESTATUS[0]} -ne 0 ]]; then
-  exit 1
+if [[ $prebuilt -eq 0 ]]; then
+  echo 'Setting up virtualenv'
+  "$py" "$DATA_DIR/virtualenv.py" "$1"
+  VIRTUAL_ENV="$(cd "$1"; pwd)"
+
+  if [[ $fast -eq 1 && ! -f "$DATA_DIR/wheels.txt" ]]; then
+    echo 'No wheel list available, installing with pip'
+    fast=0
+  fi
+
+  if [[ $fast -eq 1 ]]; then
+    echo 'Installing %(name)s (fast)'
+    if ! "$VIRTUAL_ENV/bin/python" "$DATA_DIR/fast_install.py" \
+        "$DATA_DIR"; then
+      echo 'Fast install failed, installing with pip' >&2
+      fast=0
+      rm -rf "$VIRTUAL_ENV"
+      "$py" "$DATA_DIR/virtualenv.py" "$VIRTUAL_ENV"
+    fi
+  fi
+
+  if [[ $fast -eq 0 ]]; then
+    INSTALL_ARGS=''
+    if [[ -f "$DATA_DIR/requirements.txt" ]]; then
+      INSTALL_ARGS="$INSTALL_ARGS"\ -r\ "$DATA_DIR/requirements.txt"
+    fi
+
+    echo 'Installing %(name)s'
+    "$VIRTUAL_ENV/bin/pip" install --pre --no-index --no-compile \
+      --find-links "$DATA_DIR" wheel $INSTALL_ARGS %(pkg)s | grep -v '^$'
+    if [[ ${PIPESTATUS[0]} -ne 0 ]]; then
+      exit 1
+    fi
+
+    echo 'Verifying install'
+    "$VIRTUAL_ENV/bin/pip" check || \
+        { echo 'Broken requirements detected' >&2; exit 1; }
+  fi
 fi
 
-echo 'Verifying install'
-"$VIRTUAL_ENV/bin/pip" check || \
-    { echo 'Broken requirements detected' >&2; exit 1; }
+if [[ $compile -eq 1 ]]; then
+  echo 'Compiling bytecode'
+  COMPILE_ARGS='-q'
+  if [[ $unchecked_hash -eq 1 ]]; then
+    if "$VIRTUAL_ENV/bin/python" -c \
+        'import sys; sys.exit(sys.version_info < (3, 7))'; then
+      COMPILE_ARGS="$COMPILE_ARGS --invalidation-mode unchecked-hash"
+    else
+      echo 'Unchecked hash based pycs require Python 3.7' >&2
+    fi
+  fi
+  CPUS="$(getconf _NPROCESSORS_ONLN 2> /dev/null || echo 1)"
+  find "$VIRTUAL_ENV"/lib/python*/site-packages -name '*.py' -print0 | \
+    xargs -0 -n 200 -P "$CPUS" \
+      "$VIRTUAL_ENV/bin/python" -m compileall $COMPILE_ARGS > /dev/null || \
+    echo 'Some modules could not be compiled' >&2
+fi
 
 # Potential post installation
 cd "$HERE"
@@ -111,43 +240,479 @@ echo 'Done.'
 '''
 
 
+FAST_INSTALLER = r'''# Fast installer for platter artifacts.
+#
+# Installs the wheels listed in wheels.txt into the running interpreter by
+# unpacking them directly.  The exact set of wheels was resolved when the
+# package was built so no dependency resolution is necessary.  Wheels of
+# distributions that are already installed in the same version are
+# skipped, other versions are replaced like pip does.
+import os
+import re
+import sys
+import csv
+import base64
+import shutil
+import hashlib
+import zipfile
+import sysconfig
+import threading
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+SCRIPT = """#!%(python)s
+# -*- coding: utf-8 -*-
+import re
+import sys
+from %(module)s import %(import_name)s
+if __name__ == '__main__':
+    sys.argv[0] = re.sub(r'(-script\\.pyw|\\.exe)?$', '', sys.argv[0])
+    sys.exit(%(func)s())
+"""
+
+PATHS = sysconfig.get_paths()
+
+# Wheels of namespace packages can contain the same files, so writes to a
+# path are serialized.
+_write_locks = {}
+_write_locks_lock = threading.Lock()
+
+
+def normalize(name):
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def get_installed():
+    rv = {}
+    for path in set([PATHS['purelib'], PATHS['platlib']]):
+        if not os.path.isdir(path):
+            continue
+        for filename in os.listdir(path):
+            base, ext = os.path.splitext(filename)
+            if ext in ('.dist-info', '.egg-info'):
+                parts = base.split('-')
+                rv[normalize(parts[0])] = (len(parts) > 1 and parts[1] or None,
+                                           os.path.join(path, filename))
+    return rv
+
+
+def uninstall(dist_dir):
+    record = os.path.join(dist_dir, 'RECORD')
+    if not os.path.isfile(record):
+        sys.exit('Cannot replace %s' % os.path.basename(dist_dir))
+    base = os.path.dirname(dist_dir)
+    with open(record) as f:
+        for row in csv.reader(f):
+            if not row:
+                continue
+            try:
+                os.remove(os.path.normpath(os.path.join(base, row[0])))
+            except OSError:
+                pass
+    shutil.rmtree(dist_dir, ignore_errors=True)
+
+
+def record_hash(data):
+    digest = base64.urlsafe_b64encode(hashlib.sha256(data).digest())
+    return 'sha256=' + digest.decode('ascii').rstrip('=')
+
+
+def write_file(target, data, mode=None):
+    dirname = os.path.dirname(target)
+    try:
+        os.makedirs(dirname)
+    except OSError:
+        if not os.path.isdir(dirname):
+            raise
+    with _write_locks_lock:
+        lock = _write_locks.setdefault(target, threading.Lock())
+    with lock:
+        with open(target, 'wb') as f:
+            f.write(data)
+        if mode is not None:
+            os.chmod(target, mode)
+
+
+def get_executable(gui=False):
+    if gui and os.name == 'nt':
+        pythonw = os.path.join(os.path.dirname(sys.executable),
+                               'pythonw.exe')
+        if os.path.isfile(pythonw):
+            return pythonw
+    return sys.executable
+
+
+def parse_entry_points(text):
+    section = None
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line[0] in '#;':
+            continue
+        if line[0] == '[':
+            section = line.strip('[]').strip()
+        elif section in ('console_scripts', 'gui_scripts') and '=' in line:
+            name, value = line.split('=', 1)
+            module, func = value.split('[')[0].strip().split(':')
+            yield name.strip(), module.strip(), func.strip()
+
+
+def install_wheel(filename):
+    f = zipfile.ZipFile(filename)
+    try:
+        dist_info = [x.split('/')[0] for x in f.namelist()
+                     if x.split('/')[0].endswith('.dist-info')][0]
+        data_dir = dist_info[:-10] + '.data'
+        meta = f.read(dist_info + '/WHEEL').decode('utf-8')
+        if re.search(r'^Root-Is-Purelib:\s*true\s*$', meta, re.I | re.M):
+            lib_dir = PATHS['purelib']
+        else:
+            lib_dir = PATHS['platlib']
+        schemes = {
+            'purelib': PATHS['purelib'],
+            'platlib': PATHS['platlib'],
+            'scripts': PATHS['scripts'],
+            'data': PATHS['data'],
+            'headers': os.path.join(sys.prefix, 'include', 'site',
+                                    'python%d.%d' % sys.version_info[:2],
+                                    dist_info.split('-')[0]),
+        }
+
+        installed = []
+        for info in f.infolist():
+            name = info.filename
+            if name.endswith('/') or name == dist_info + '/RECORD':
+                continue
+            data = f.read(info)
+            mode = None
+            if (info.external_attr >> 16) & 0o111:
+                mode = 0o755
+            if name.startswith(data_dir + '/'):
+                scheme, name = name[len(data_dir) + 1:].split('/', 1)
+                target = os.path.join(schemes[scheme], name)
+                if scheme == 'scripts':
+                    mode = 0o755
+                    match = re.match(br'#!python(w?)(?=\s)', data)
+                    if match is not None:
+                        exe = get_executable(bool(match.group(1)))
+                        data = b'#!' + exe.encode('utf-8') + \
+                            data[match.end():]
+            else:
+                target = os.path.join(lib_dir, name)
+            write_file(target, data, mode)
+            installed.append((target, data))
+
+        if dist_info + '/entry_points.txt' in f.namelist():
+            text = f.read(dist_info + '/entry_points.txt').decode('utf-8')
+            for name, module, func in parse_entry_points(text):
+                data = (SCRIPT % {
+                    'python': sys.executable,
+                    'module': module,
+                    'import_name': func.split('.')[0],
+                    'func': func,
+                }).encode('utf-8')
+                target = os.path.join(PATHS['scripts'], name)
+                write_file(target, data, 0o755)
+                installed.append((target, data))
+
+        target = os.path.join(lib_dir, dist_info, 'INSTALLER')
+        write_file(target, b'platter\n')
+        installed.append((target, b'platter\n'))
+    finally:
+        f.close()
+
+    record = []
+    for target, data in installed:
+        path = os.path.relpath(target, lib_dir).replace(os.sep, '/')
+        if ',' in path or '"' in path:
+            path = '"%s"' % path.replace('"', '""')
+        record.append('%s,%s,%d' % (path, record_hash(data), len(data)))
+    record.append('%s/RECORD,,' % dist_info)
+    write_file(os.path.join(lib_dir, dist_info, 'RECORD'),
+               ('\n'.join(record) + '\n').encode('utf-8'))
+    return os.path.basename(filename)
+
+
+def main(data_dir):
+    with open(os.path.join(data_dir, 'wheels.txt')) as f:
+        wheels = [x.strip() for x in f if x.strip()]
+    installed = get_installed()
+    filenames = []
+    for filename in wheels:
+        name, version = filename.split('-')[:2]
+        dist = installed.get(normalize(name))
+        if dist is not None:
+            if dist[0] == version:
+                continue
+            print('  Replacing %s %s' % (name, dist[0]))
+            uninstall(dist[1])
+        filenames.append(os.path.join(data_dir, filename))
+    wheels = filenames
+    pool = ThreadPool(max(cpu_count(), 1))
+    try:
+        for filename in pool.imap_unordered(install_wheel, wheels):
+            print('  Installed %s' % filename)
+    finally:
+        pool.close()
+        pool.join()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1])
+'''
+
+
+RELOCATOR = r'''# Virtualenv relocator for platter artifacts.
+#
+# Rewrites the paths in a prebuilt virtualenv that was copied to a new
+# location.  The path the virtualenv was built in is recorded in its
+# .platter-prefix file.  Usage: python relocate.py VIRTUAL_ENV
+import os
+import sys
+
+
+def iter_candidates(venv):
+    bin_dir = os.path.join(venv, 'bin')
+    for filename in sorted(os.listdir(bin_dir)):
+        yield os.path.join(bin_dir, filename)
+    lib_dir = os.path.join(venv, 'lib')
+    for dirpath, dirnames, filenames in os.walk(lib_dir):
+        for filename in filenames:
+            if filename.endswith(('.pth', '.egg-link')):
+                yield os.path.join(dirpath, filename)
+
+
+def relocate(filename, old, new):
+    if os.path.islink(filename) or not os.path.isfile(filename):
+        return False
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if old not in data or b'\0' in data[:1024]:
+        return False
+    mode = os.stat(filename).st_mode
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data.replace(old, new))
+    os.chmod(tmp, mode)
+    os.rename(tmp, filename)
+    return True
+
+
+def main(venv):
+    venv = os.path.abspath(venv)
+    prefix_file = os.path.join(venv, '.platter-prefix')
+    with open(prefix_file, 'rb') as f:
+        old = f.read().strip()
+    new = venv.encode('utf-8')
+    if old != new:
+        for filename in iter_candidates(venv):
+            relocate(filename, old, new)
+        with open(prefix_file, 'wb') as f:
+            f.write(new + b'\n')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1])
+'''
+
+
+DELTA_APPLIER = r'''# Delta applier for platter artifacts.
+#
+# Rebuilds a platter artifact from the extracted previous artifact and the
+# files in this delta.  Usage: python apply_delta.py OLD_DIR DST_DIR
+import os
+import sys
+import json
+import shutil
+import hashlib
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def fail(message):
+    sys.stderr.write('Error: %s\n' % message)
+    sys.exit(1)
+
+
+def hash_file(filename):
+    h = hashlib.sha256()
+    try:
+        with open(filename, 'rb') as f:
+            while 1:
+                chunk = f.read(65536)
+                if not chunk:
+                    break
+                h.update(chunk)
+    except (IOError, OSError):
+        return None
+    return h.hexdigest()
+
+
+def main(old_dir, dst_dir):
+    with open(os.path.join(HERE, 'delta.json')) as f:
+        delta = json.load(f)
+    try:
+        with open(os.path.join(old_dir, 'info.json')) as f:
+            old_info = json.load(f)
+    except (IOError, OSError, ValueError):
+        fail('%s is not an extracted platter artifact' % old_dir)
+    if old_info != delta['from']:
+        fail('this delta applies to %s %s but %s contains %s %s' % (
+            delta['from']['name'], delta['from']['version'], old_dir,
+            old_info.get('name'), old_info.get('version')))
+    if os.path.exists(dst_dir):
+        fail('%s already exists' % dst_dir)
+
+    tmp_dir = dst_dir.rstrip('/') + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    for path, (digest, mode) in sorted(delta['files'].items()):
+        src = os.path.join(HERE, 'files', path)
+        if not os.path.isfile(src):
+            src = os.path.join(old_dir, path)
+        if os.path.islink(src) or not os.path.isfile(src) or \
+           hash_file(src) != digest:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            fail('%s is missing or was modified' % src)
+        dst = os.path.join(tmp_dir, path)
+        if not os.path.isdir(os.path.dirname(dst)):
+            os.makedirs(os.path.dirname(dst))
+        shutil.copyfile(src, dst)
+        os.chmod(dst, mode)
+    for path, target in sorted(delta.get('links', {}).items()):
+        dst = os.path.join(tmp_dir, path)
+        if not os.path.isdir(os.path.dirname(dst)):
+            os.makedirs(os.path.dirname(dst))
+        os.symlink(target, dst)
+    os.rename(tmp_dir, dst_dir)
+    print('Created %s %s in %s' % (delta['to']['name'],
+                                   delta['to']['version'], dst_dir))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        fail('usage: apply_delta.py OLD_DIR DST_DIR')
+    main(sys.argv[1], sys.argv[2])
+'''
+
+
 class Log(object):
+    """Writes the build log to the terminal.  If `quiet` is enabled, the
+    output of child processes is spooled to a temporary file and only
+    shown if the process failed.  If `events` is a file, all messages
+    and progress information are additionally written to it as JSON
+    lines.
+    """
 
-    def __init__(self):
-        self.indentation = 0
+    # Serializes the writes of builds that share an events file.
+    _events_lock = threading.Lock()
+
+    def __init__(self, prefix='', quiet=False, events=None):
+        self.prefix = prefix
+        self.quiet = quiet
+        self.events = events
+        # Phases of a build run in multiple threads, each of them keeps
+        # its own indentation and spooled process output.
+        self._local = threading.local()
+
+    @property
+    def indentation(self):
+        return getattr(self._local, 'indentation', 0)
+
+    @property
+    def spool(self):
+        return getattr(self._local, 'spool', None)
+
+    @spool.setter
+    def spool(self, value):
+        self._local.spool = value
 
     def indent(self):
-        self.indentation += 1
+        self._local.indentation = self.indentation + 1
 
     def outdent(self):
-        self.indentation -= 1
+        self._local.indentation = self.indentation - 1
 
     def echo(self, s):
-        prefix = '  ' * self.indentation
+        prefix = self.prefix + '  ' * self.indentation
         click.echo(prefix + s)
 
+    def event(self, kind, **data):
+        if self.events is None:
+            return
+        data['event'] = kind
+        data['time'] = time.time()
+        if self.prefix:
+            data['build'] = self.prefix.strip()
+        line = json.dumps(data) + '\n'
+        with self._events_lock:
+            self.events.write(line)
+            self.events.flush()
+
     def info(self, fmt, *args, **kwargs):
-        self.echo(fmt.format(*args, **kwargs))
+        msg = fmt.format(*args, **kwargs)
+        self.echo(msg)
+        self.event('message', level='info', message=click.unstyle(msg))
 
     def error(self, fmt, *args, **kwargs):
-        return self.info('Error: ' + click.style(fmt, fg='red'),
-                         *args, **kwargs)
+        msg = fmt.format(*args, **kwargs)
+        self.echo('Error: ' + click.style(msg, fg='red'))
+        self.event('message', level='error', message=msg)
+
+    def child(self, prefix):
+        """Returns a log for a concurrent build with the given prefix."""
+        return Log(prefix=prefix, quiet=self.quiet, events=self.events)
+
+    def echo_lines(self, lines, color=None):
+        prefix = self.prefix + '  ' * self.indentation
+        click.echo('\n'.join(prefix + click.style(line.rstrip(), fg=color)
+                             for line in lines))
 
     def process_stream_output(self, process):
-        fds = set([process.stdout, process.stderr])
-        while fds:
-            for f in select.select(fds, [], [])[0]:
-                try:
-                    line = f.readline()
-                    if not line:
-                        fds.discard(f)
-                        continue
-                except OSError as e:
-                    if e.errno != errno.EINTR:
-                        raise
-                else:
-                    color = f == process.stdout and 'cyan' or 'yellow'
-                    self.echo(click.style(line.rstrip(), fg=color))
+        """Forwards the output of a process.  The pipes are read in chunks
+        as soon as data is available so that the child never blocks on a
+        full pipe.
+        """
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
+        if self.quiet:
+            self.spool = tempfile.TemporaryFile()
+
+        colors = {process.stdout.fileno(): 'cyan',
+                  process.stderr.fileno(): 'yellow'}
+        buffers = dict((fd, b'') for fd in colors)
+        while buffers:
+            try:
+                ready = select.select(list(buffers), [], [])[0]
+            except (select.error, OSError) as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                continue
+            for fd in ready:
+                chunk = os.read(fd, 65536)
+                if self.spool is not None:
+                    self.spool.write(chunk)
+                    if not chunk:
+                        del buffers[fd]
+                    continue
+                if not chunk:
+                    rest = buffers.pop(fd)
+                    if rest:
+                        self.echo_lines([rest], colors[fd])
+                    continue
+                lines = (buffers[fd] + chunk).split(b'\n')
+                buffers[fd] = lines.pop()
+                if lines:
+                    self.echo_lines(lines, colors[fd])
+
+    def show_spooled_output(self):
+        """Shows the spooled output of the last process (if any)."""
+        if self.spool is None:
+            return
+        self.spool.seek(0)
+        self.echo_lines(self.spool.read().splitlines(), 'yellow')
+        self.spool.close()
+        self.spool = None
 
     @contextmanager
     def indented(self):
@@ -175,6 +740,26 @@ def find_exe(name):
     return name
 
 
+def get_interpreter_tags(pythons):
+    """Returns the tags of the given interpreters which tell the builds
+    for them apart (see :data:`INTERPRETER_TAG_SCRIPT`).  Interpreters
+    that share a tag cannot be built for together.
+    """
+    rv = []
+    for python in pythons:
+        try:
+            tag = subprocess.check_output(
+                [python, '-c', INTERPRETER_TAG_SCRIPT]).strip()
+        except (OSError, subprocess.CalledProcessError):
+            raise click.UsageError('Could not run the interpreter %s.'
+                                   % python)
+        if tag in rv:
+            raise click.UsageError('The interpreters %s and %s are both %s.'
+                                   % (pythons[rv.index(tag)], python, tag))
+        rv.append(tag)
+    return rv
+
+
 def make_spec(pkg, version=None):
     if version is None:
         return pkg
@@ -183,6 +768,63 @@ def make_spec(pkg, version=None):
     return '%s==%s' % (pkg, version)
 
 
+def parse_dist_filename(filename):
+    """Returns the name and version of a distribution from the filename
+    of a wheel or a source distribution.
+    """
+    filename = os.path.basename(filename)
+    if filename.endswith('.whl'):
+        return tuple(filename.split('-')[:2])
+    for ext in '.tar.gz', '.tar.bz2', '.tgz', '.zip':
+        if filename.endswith(ext):
+            filename = filename[:-len(ext)]
+            break
+    return tuple(filename.rsplit('-', 1))
+
+
+def version_key(version):
+    return [int(x) if x.isdigit() else x
+            for x in re.split(r'(\d+)', version) if x]
+
+
+def parse_size(ctx, param, value):
+    """Parses a size like ``500M`` or ``10G`` into bytes."""
+    if value is None:
+        return None
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)b?\s*$', value, re.I)
+    if match is None:
+        raise click.BadParameter('%r is not a valid size' % value)
+    number, unit = match.groups()
+    return int(float(number) * 1024 ** ' kmgt'.index(unit.lower() or ' '))
+
+
+def check_compress_level(format, level):
+    """Makes sure that a compression level fits the format."""
+    if level is None:
+        return
+    if format not in COMPRESS_LEVELS:
+        raise click.BadParameter('the %s format is not compressed with a '
+                                 'level' % format,
+                                 param_hint='--compress-level')
+    low, high = COMPRESS_LEVELS[format]
+    if not low <= level <= high:
+        raise click.BadParameter('%d is not between %d and %d for the %s '
+                                 'format' % (level, low, high, format),
+                                 param_hint='--compress-level')
+
+
+def parse_duration(ctx, param, value):
+    """Parses a duration like ``12h`` or ``30d`` into seconds."""
+    if value is None:
+        return None
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([smhdw]?)\s*$', value, re.I)
+    if match is None:
+        raise click.BadParameter('%r is not a valid duration' % value)
+    number, unit = match.groups()
+    return float(number) * {'': 1, 's': 1, 'm': 60, 'h': 3600,
+                            'd': 86400, 'w': 604800}[unit.lower()]
+
+
 def find_closest_package():
     node = os.getcwd()
     while 1:
@@ -195,6 +837,28 @@ def find_closest_package():
     raise click.UsageError('Cannot discover package, you need to be explicit.')
 
 
+def find_projects(patterns):
+    """Returns the package folders for a list of paths or glob patterns.
+    Patterns only match folders that contain a setup.py.
+    """
+    rv = []
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            matches = [x for x in sorted(glob.glob(pattern))
+                       if os.path.isfile(os.path.join(x, 'setup.py'))]
+            if not matches:
+                raise click.UsageError('No packages match %s' % pattern)
+        elif os.path.isfile(os.path.join(pattern, 'setup.py')):
+            matches = [pattern]
+        else:
+            raise click.UsageError('Cannot find a setup.py in %s' % pattern)
+        for path in matches:
+            path = os.path.abspath(path)
+            if path not in rv:
+                rv.append(path)
+    return rv
+
+
 def get_cache_dir(app_name):
     if WIN:
         folder = os.environ.get('LOCALAPPDATA')
@@ -214,12 +878,991 @@ def get_default_wheel_cache():
     return get_cache_dir('platter')
 
 
+def get_default_venv_pool():
+    return os.path.join(get_cache_dir('platter'), 'venvs')
+
+
+def get_default_metadata_cache():
+    return os.path.join(get_cache_dir('platter'), 'metadata')
+
+
+def get_default_daemon_socket():
+    return os.path.join(get_cache_dir('platter'), 'daemon.sock')
+
+
+def get_default_job_log_dir():
+    return os.path.join(get_cache_dir('platter'), 'jobs')
+
+
+def parse_metadata(text):
+    """Returns the name and version from the contents of a ``PKG-INFO``
+    or ``METADATA`` file.
+    """
+    msg = Parser().parsestr(text)
+    return msg['Name'], msg['Version']
+
+
+def hash_file(filename, h=None):
+    if h is None:
+        h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        while 1:
+            chunk = f.read(65536)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h
+
+
+def lock_file(f, blocking=True):
+    """Takes an exclusive lock on an open file that is released when the
+    file is closed.  If `blocking` is not set and another process holds
+    the lock, an `IOError` is raised.  Without fcntl (on Windows) no lock
+    is taken.
+    """
+    if fcntl is None:
+        return
+    operation = fcntl.LOCK_EX
+    if not blocking:
+        operation |= fcntl.LOCK_NB
+    fcntl.flock(f.fileno(), operation)
+
+
+def link_file(src, dst, hardlink=False):
+    """Places a file at a new location in the cheapest way possible.  On
+    filesystems that support it a copy-on-write clone (reflink) is
+    created, otherwise the file is copied.  If `hardlink` is set, a
+    hardlink is tried before copying.  A hardlink shares the data with
+    the source and file permissions do not protect it from root, so this
+    must only be used if neither file is modified in place afterwards.
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    if sys.platform.startswith('linux'):
+        try:
+            with open(src, 'rb') as fsrc:
+                with open(dst, 'wb') as fdst:
+                    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            shutil.copystat(src, dst)
+            return 'reflink'
+        except (IOError, OSError):
+            try:
+                os.remove(dst)
+            except OSError:
+                pass
+    # Python 2 has no os.link on Windows.
+    if hardlink and hasattr(os, 'link'):
+        try:
+            os.link(src, dst)
+            return 'hardlink'
+        except OSError:
+            pass
+    shutil.copy2(src, dst)
+    return 'copy'
+
+
+def link_into_store(filename, store, digest):
+    """Replaces a file with a hardlink to its copy in a content addressed
+    store which keeps one file per sha256 digest.  If the store does not
+    have the file yet, it is linked into the store instead.  Returns
+    `False` if the file could not be linked.
+    """
+    if not hasattr(os, 'link'):
+        return False
+    target = os.path.join(store, digest[:2], digest)
+    suffix = '.%d-%d.tmp' % (os.getpid(), threading.current_thread().ident)
+    try:
+        if not os.path.isfile(target):
+            try:
+                os.makedirs(os.path.dirname(target))
+            except OSError:
+                if not os.path.isdir(os.path.dirname(target)):
+                    raise
+            os.link(filename, target + suffix)
+            os.rename(target + suffix, target)
+            make_immutable(target)
+        elif not os.path.samefile(filename, target):
+            os.link(target, filename + suffix)
+            os.rename(filename + suffix, filename)
+    except OSError:
+        return False
+    return True
+
+
+def collect_store_garbage(store):
+    """Removes the files from a content addressed store that are not
+    linked into any artifact anymore and yields their paths.
+    """
+    for dirpath, dirnames, filenames in os.walk(store):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            try:
+                if os.stat(path).st_nlink > 1:
+                    continue
+                os.remove(path)
+            except OSError:
+                continue
+            yield path
+
+
+def make_immutable(filename):
+    """Removes the write permissions of a file.  This is done for all
+    files in the cache so that they are not modified by accident.
+    """
+    mode = stat.S_IMODE(os.stat(filename).st_mode)
+    os.chmod(filename, mode & ~0222)
+
+
+def make_writable(filename):
+    """Gives the owner write permissions to a copy of a cached file that
+    was made read-only by :func:`make_immutable`.
+    """
+    mode = stat.S_IMODE(os.stat(filename).st_mode)
+    if not mode & stat.S_IWUSR:
+        os.chmod(filename, mode | stat.S_IWUSR)
+
+
+def copy_artifact(src, dst):
+    """Copies a build artifact (either an archive or a folder) to a new
+    location.  The copy is first created under a unique temporary name so
+    that nobody ever observes a partially copied artifact, even if
+    multiple builds copy to the same location.
+    """
+    folder = os.path.dirname(dst) or '.'
+    prefix = '.' + os.path.basename(dst)
+    if os.path.isdir(src):
+        tmp_dir = tempfile.mkdtemp(prefix=prefix, dir=folder)
+        tmp = os.path.join(tmp_dir, os.path.basename(dst))
+    else:
+        tmp_dir = None
+        fd, tmp = tempfile.mkstemp(prefix=prefix, dir=folder)
+        os.close(fd)
+    try:
+        if tmp_dir is not None:
+            shutil.copytree(src, tmp, symlinks=True)
+        else:
+            shutil.copy2(src, tmp)
+        os.rename(tmp, dst)
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        elif os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def get_lock_filename(tag=None):
+    """Returns the name of the lock file next to the project.  Builds for
+    multiple interpreters write one lock per interpreter tag.
+    """
+    if tag is None:
+        return LOCK_FILENAME
+    return 'platter-%s.lock' % tag
+
+
+def is_lock_filename(filename):
+    return filename == LOCK_FILENAME or (
+        filename.startswith('platter-') and filename.endswith('.lock'))
+
+
+def extract_artifact(artifact, target):
+    """Extracts an artifact into the target folder and returns the path
+    to the extracted package folder.  Folders are returned unchanged.
+    """
+    if os.path.isdir(artifact):
+        return artifact
+    if artifact.endswith('.zip'):
+        f = zipfile.ZipFile(artifact)
+    elif artifact.endswith('.tar.zst') and zstandard is not None:
+        reader = zstandard.ZstdDecompressor().stream_reader(
+            open(artifact, 'rb'))
+        f = tarfile.open(fileobj=reader, mode='r|')
+    elif artifact.endswith('.tar.xz') and lzma is not None:
+        f = tarfile.open(fileobj=lzma.LZMAFile(artifact), mode='r|')
+    else:
+        f = tarfile.open(artifact)
+    try:
+        f.extractall(target)
+    finally:
+        f.close()
+    return os.path.join(target, os.listdir(target)[0])
+
+
+def iter_tree(root):
+    """Yields the paths of all files below a folder relative to it.
+    Symlinks (also to folders) are yielded as well but never followed.
+    """
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        links = [x for x in dirnames
+                 if os.path.islink(os.path.join(dirpath, x))]
+        for filename in sorted(filenames + links):
+            yield os.path.relpath(os.path.join(dirpath, filename),
+                                  root).replace(os.sep, '/')
+
+
+def make_compressor(format, level=None, threads=1):
+    """Creates a compressor object for a tar based format.  All of them
+    provide the ``compress`` and ``flush`` methods.
+    """
+    if format == 'tar.gz':
+        return zlib.compressobj(9 if level is None else level,
+                                zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif format == 'tar.bz2':
+        return bz2.BZ2Compressor(9 if level is None else level)
+    elif format == 'tar.xz':
+        return lzma.LZMACompressor(preset=6 if level is None else level)
+    elif format == 'tar.zst':
+        return zstandard.ZstdCompressor(
+            level=3 if level is None else level,
+            threads=threads if threads > 1 else 0).compressobj()
+    raise ValueError('Unknown format %r' % format)
+
+
+class HashingFile(object):
+    """Wraps a file object and computes digests of all data that is read
+    from or written to it.
+    """
+
+    def __init__(self, fileobj, algorithms=('sha256',)):
+        self.fileobj = fileobj
+        self.hashes = [(name, hashlib.new(name)) for name in algorithms]
+        self.size = 0
+
+    def _update(self, data):
+        for _, h in self.hashes:
+            h.update(data)
+        self.size += len(data)
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self._update(data)
+        return data
+
+    def write(self, data):
+        self._update(data)
+        self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        self.fileobj.close()
+
+    def hexdigests(self):
+        return dict((name, h.hexdigest()) for name, h in self.hashes)
+
+
+class CompressedFile(object):
+    """A write only file object that compresses everything written to
+    it with a compressor before passing it on to the given file object.
+    """
+
+    def __init__(self, fileobj, compressor):
+        self.fileobj = fileobj
+        self.compressor = compressor
+        self.closed = False
+
+    def write(self, data):
+        data = self.compressor.compress(data)
+        if data:
+            self.fileobj.write(data)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.fileobj.write(self.compressor.flush())
+
+
+def _compress_block(data, compresslevel):
+    c = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return c.compress(data) + c.flush(zlib.Z_SYNC_FLUSH)
+
+
+class ParallelGzipFile(object):
+    """A write only file object that writes a gzip stream to the given
+    file object.  Similar to pigz the data is split into blocks that are
+    compressed independently by a pool of threads (zlib releases the GIL
+    while compressing).  Every block ends on a byte boundary so the
+    compressed blocks can be concatenated into a single deflate stream
+    which any regular gzip implementation can decompress.
+    """
+
+    block_size = 128 * 1024
+
+    def __init__(self, fileobj, threads, compresslevel=9):
+        self.fileobj = fileobj
+        self.compresslevel = compresslevel
+        self.pool = ThreadPool(threads)
+        self.max_pending = threads * 2
+        self.pending = deque()
+        self.buffer = []
+        self.buffered = 0
+        self.crc = zlib.crc32(b'')
+        self.size = 0
+        self.closed = False
+        self.fileobj.write(b'\x1f\x8b\x08\x00' +
+                           struct.pack('<L', int(time.time())) +
+                           b'\x00\xff')
+
+    def _submit(self):
+        if not self.buffered:
+            return
+        block = b''.join(self.buffer)
+        del self.buffer[:]
+        self.buffered = 0
+        self.pending.append(self.pool.apply_async(
+            _compress_block, (block, self.compresslevel)))
+        while len(self.pending) > self.max_pending:
+            self.fileobj.write(self.pending.popleft().get())
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.block_size:
+            self._submit()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._submit()
+            while self.pending:
+                self.fileobj.write(self.pending.popleft().get())
+            # An empty final block terminates the deflate stream.
+            self.fileobj.write(b'\x03\x00')
+            self.fileobj.write(struct.pack('<LL', self.crc & 0xffffffff,
+                                           self.size & 0xffffffff))
+        finally:
+            self.pool.close()
+            self.pool.join()
+
+
+class ArchiveWriter(object):
+    """Writes a build artifact while the build is still running.  Files
+    are added to the archive as soon as they are produced.  When the
+    archive is closed, everything in the base folder that was not added
+    yet (for instance the output of build scripts) is added as well, a
+    ``MANIFEST`` with the sha256 and size of every file is written and
+    the artifact is moved into its final location.
+
+    The digests of tar based archives are calculated while they are
+    written.  Zip files are rewritten in place by :mod:`zipfile`, so they
+    are hashed once they are finished.
+
+    If `defer` is set (because a postbuild script still modifies the base
+    folder) files are only placed in the base folder and the archive is
+    written from the final tree when it is closed.
+    """
+
+    digest_algorithms = ('md5', 'sha1', 'sha256')
+
+    def __init__(self, builder, root, base, format, defer=False):
+        self.root = root
+        self.base = base
+        self.format = format
+        self.defer = defer
+        self.added = set()
+        self.manifest = {}
+        self.digests = {}
+        self._lock = threading.RLock()
+        self._raw = None
+        self._stream = None
+        self._archive = None
+
+        self.store = None
+        if format == 'dir':
+            self.filename = os.path.join(builder.output, base)
+            self.tmp_filename = None
+            if builder.dedupe:
+                self.store = os.path.join(builder.output, STORE_FOLDER)
+            return
+
+        archive_name = base + '.' + format
+        self.filename = os.path.join(builder.output, archive_name)
+        self.tmp_filename = os.path.join(builder.output, '.' + archive_name)
+        try:
+            self._raw = open(self.tmp_filename, 'wb')
+            if format != 'zip':
+                self._raw = HashingFile(self._raw, self.digest_algorithms)
+            if format == 'zip':
+                self._archive = zipfile.ZipFile(self._raw, 'w',
+                                                zipfile.ZIP_DEFLATED)
+            else:
+                self._stream = builder.open_compressed_stream(self._raw,
+                                                              format)
+                self._archive = tarfile.open(fileobj=self._stream,
+                                             mode='w|')
+                self._add(root, '')
+        except Exception:
+            self.abort()
+            raise
+
+    def _add(self, filename, arcname):
+        self.added.add(arcname)
+        if arcname:
+            arcname = self.base + '/' + arcname
+        else:
+            arcname = self.base
+        # Files from the cache are read-only, which must not carry over
+        # into the artifact.
+        if self.format == 'zip':
+            if not os.path.isdir(filename):
+                self._archive.write(filename, arcname)
+                self._archive.infolist()[-1].external_attr |= \
+                    stat.S_IWUSR << 16
+                self._record(filename, arcname)
+            return
+        info = self._archive.gettarinfo(filename, arcname)
+        if not info.isreg():
+            self._archive.addfile(info)
+            return
+        info.mode |= stat.S_IWUSR
+        with open(filename, 'rb') as f:
+            reader = HashingFile(f)
+            self._archive.addfile(info, reader)
+        self.manifest[arcname[len(self.base) + 1:]] = (
+            reader.hexdigests()['sha256'], info.size)
+
+    def _record(self, filename, arcname):
+        if os.path.isfile(filename) and not os.path.islink(filename):
+            self.manifest[arcname[len(self.base) + 1:]] = (
+                hash_file(filename).hexdigest(), os.path.getsize(filename))
+
+    def add(self, filename, arcname):
+        """Adds a single file to the archive under the given name which
+        is relative to the root of the artifact.  Files that were already
+        added are ignored.
+        """
+        with self._lock:
+            self._add_locked(filename, arcname)
+
+    def _add_locked(self, filename, arcname):
+        if arcname in self.added:
+            return
+        if self.format == 'dir' or self.defer:
+            target = os.path.join(self.root, arcname)
+            if os.path.abspath(filename) != target:
+                link_file(filename, target)
+                make_writable(target)
+            if self.format == 'dir':
+                self.added.add(arcname)
+            return
+        parts = arcname.split('/')
+        for idx in range(1, len(parts)):
+            dirname = '/'.join(parts[:idx])
+            if dirname not in self.added:
+                self._add(os.path.join(self.root, dirname), dirname)
+        self._add(filename, arcname)
+
+    def add_tree(self):
+        """Adds all files below the root that were not added yet."""
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames.sort()
+            prefix = os.path.relpath(dirpath, self.root).replace(os.sep, '/')
+            for name in dirnames + sorted(filenames):
+                arcname = name if prefix == '.' else prefix + '/' + name
+                self.add(os.path.join(dirpath, name), arcname)
+
+    def record_tree(self):
+        """Records the digests of all files below the root."""
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            prefix = os.path.relpath(dirpath, self.root).replace(os.sep, '/')
+            for name in filenames:
+                arcname = name if prefix == '.' else prefix + '/' + name
+                self._record(os.path.join(dirpath, name),
+                             self.base + '/' + arcname)
+
+    def write_manifest(self):
+        filename = os.path.join(self.root, 'MANIFEST')
+        with open(filename, 'w') as f:
+            for path, (digest, size) in sorted(self.manifest.items()):
+                f.write('%s %d %s\n' % (digest, size, path))
+        self.add(filename, 'MANIFEST')
+
+    def close(self):
+        """Finishes the archive and returns the path to the artifact."""
+        self.defer = False
+        if self.format == 'dir':
+            self.record_tree()
+        else:
+            self.add_tree()
+        self.write_manifest()
+        if self.format == 'dir':
+            os.rename(self.root, self.filename)
+            if self.store is not None:
+                self.link_wheels_into_store()
+            return self.filename
+        self._archive.close()
+        if self._stream is not None:
+            self._stream.close()
+        self._raw.close()
+        if self.format == 'zip':
+            with open(self.tmp_filename, 'rb') as f:
+                hasher = HashingFile(f, self.digest_algorithms)
+                while hasher.read(65536):
+                    pass
+            self.digests = hasher.hexdigests()
+        else:
+            self.digests = self._raw.hexdigests()
+        os.rename(self.tmp_filename, self.filename)
+        return self.filename
+
+    def link_wheels_into_store(self):
+        """Hardlinks the wheels of a folder artifact into the store of
+        the output folder so that every wheel is only kept once no matter
+        how many artifacts contain it.
+        """
+        for path, (digest, size) in sorted(self.manifest.items()):
+            if path.endswith('.whl'):
+                link_into_store(os.path.join(self.filename, path),
+                                self.store, digest)
+
+    def abort(self):
+        if self.tmp_filename is None:
+            return
+        for f in self._archive, self._stream, self._raw:
+            try:
+                if f is not None:
+                    f.close()
+            except Exception:
+                pass
+        try:
+            os.remove(self.tmp_filename)
+        except OSError:
+            pass
+
+
+class BuildTimings(object):
+    """Records how long the phases of a build took and the resource usage
+    of the processes that were executed.  The CPU time and peak RSS of
+    a process are filled in by :meth:`Builder.wait` from the resource
+    usage that ``os.wait4`` reports for that process alone.
+    """
+
+    def __init__(self):
+        self.phases = []
+        self.processes = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.phases.append({'name': name,
+                                    'wall': time.time() - start})
+
+    @contextmanager
+    def process(self, cmdline):
+        rv = {'cmdline': cmdline, 'user': 0.0, 'system': 0.0,
+              'max_rss_kb': 0}
+        start = time.time()
+        try:
+            yield rv
+        finally:
+            rv['wall'] = time.time() - start
+            with self._lock:
+                self.processes.append(rv)
+
+    def to_dict(self, total):
+        return {
+            'total': total,
+            'phases': self.phases,
+            'processes': self.processes,
+        }
+
+    def report(self, log, total, limit=5):
+        log.info('Build phases:')
+        with log.indented():
+            for phase in self.phases:
+                log.info('{:<24} {:>8.2f}s {:>5.1f}%', phase['name'],
+                         phase['wall'], phase['wall'] * 100 / (total or 1))
+        if not self.processes:
+            return
+        log.info('Slowest processes:')
+        with log.indented():
+            log.info('{:>8} {:>8} {:>8} {:>10}  {}', 'wall', 'user',
+                     'system', 'max rss', 'command')
+            for proc in sorted(self.processes, key=lambda x: -x['wall'])[
+                    :limit]:
+                log.info('{:>7.2f}s {:>7.2f}s {:>7.2f}s {:>8}KB  {}',
+                         proc['wall'], proc['user'], proc['system'],
+                         proc['max_rss_kb'], ' '.join(map(autoquote, [
+                             os.path.basename(proc['cmdline'][0])] +
+                             proc['cmdline'][1:]))[:60])
+
+
+class CancelToken(object):
+    """Allows to cancel a build from another thread.  The processes of
+    the build are registered with the token while they run and are
+    terminated on cancellation.  The build then stops before its next
+    phase.
+    """
+
+    def __init__(self):
+        self.cancelled = False
+        self._processes = set()
+        self._lock = threading.Lock()
+
+    def register(self, process):
+        with self._lock:
+            self._processes.add(process)
+            if self.cancelled:
+                process.terminate()
+
+    def unregister(self, process):
+        with self._lock:
+            self._processes.discard(process)
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            for process in self._processes:
+                try:
+                    process.terminate()
+                except OSError:
+                    pass
+
+
+class PhaseScheduler(object):
+    """Runs the phases of a build in a pool of threads.  Every phase
+    starts as soon as the phases it requires are finished.  Requirements
+    on phases that were never added are ignored so optional phases can
+    be left out.  If a phase fails, no further phases are started and the
+    error is raised once the running phases are done.
+    """
+
+    def __init__(self, builder, threads=4):
+        self.builder = builder
+        self.threads = threads
+        self.phases = []
+
+    def add(self, name, func, requires=()):
+        known = set(x[0] for x in self.phases)
+        self.phases.append((name, func, [x for x in requires if x in known]))
+
+    def run(self):
+        pending = list(self.phases)
+        running = set()
+        done = set()
+        finished = []
+        cond = threading.Condition()
+        error = None
+
+        def _run(name, func):
+            exc_info = None
+            try:
+                with self.builder.phase(name):
+                    func()
+            except BaseException:
+                exc_info = sys.exc_info()
+            with cond:
+                finished.append((name, exc_info))
+                cond.notify()
+
+        pool = ThreadPool(self.threads)
+        try:
+            while pending or running:
+                if error is None:
+                    for phase in list(pending):
+                        name, func, requires = phase
+                        if all(x in done for x in requires):
+                            pending.remove(phase)
+                            running.add(name)
+                            pool.apply_async(_run, (name, func))
+                if not running:
+                    break
+                with cond:
+                    while not finished:
+                        cond.wait(0.5)
+                    name, exc_info = finished.pop(0)
+                running.discard(name)
+                if exc_info is None:
+                    done.add(name)
+                elif error is None:
+                    error = exc_info
+        finally:
+            pool.close()
+            pool.join()
+        if error is not None:
+            raise error[0], error[1], error[2]
+
+
+class WheelCache(object):
+    """The wheel cache keeps the wheels of previous builds around.  An
+    index (``index.json``) records the size, the sha256 checksum, the
+    time a file was added and the time it was last used by a build which
+    is used to evict the least recently used files.
+
+    Multiple builds can use the cache at once.  Files are published under
+    a temporary name and renamed into place and the index is read and
+    written under an exclusive lock (``.index.lock``).  Builds read the
+    cache through a lease (see :meth:`lease`) so evicting a file does
+    not affect builds that might be using it.
+    """
+
+    # Serializes index updates of builds running in the same process.
+    _lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+        self.index_filename = os.path.join(path, 'index.json')
+        self.index_lock_filename = os.path.join(path, '.index.lock')
+        self.leases_path = os.path.join(path, '.leases')
+
+    def lock_file(self, filename, blocking=True):
+        """Opens and locks one of the lock files of the cache.  The lock
+        is released when the returned file is closed.
+        """
+        try:
+            os.makedirs(self.path)
+        except OSError:
+            pass
+        f = open(filename, 'a')
+        try:
+            lock_file(f, blocking)
+        except Exception:
+            f.close()
+            raise
+        return f
+
+    def iter_files(self):
+        if not os.path.isdir(self.path):
+            return
+        for filename in os.listdir(self.path):
+            if filename[:1] != '.' and filename != 'index.json' and \
+               os.path.isfile(os.path.join(self.path, filename)):
+                yield filename
+
+    def make_entry(self, filename, now=None):
+        if now is None:
+            now = time.time()
+        path = os.path.join(self.path, filename)
+        return {
+            'size': os.path.getsize(path),
+            'sha256': hash_file(path).hexdigest(),
+            'added': now,
+            'last_used': now,
+        }
+
+    def load_index(self):
+        """Loads the index and brings it in sync with the files that
+        are actually in the cache.  Files that are not indexed yet (for
+        instance ones cached by an older version of platter) are added.
+        """
+        try:
+            with open(self.index_filename) as f:
+                index = json.load(f)
+        except (IOError, ValueError):
+            index = {}
+        files = set(self.iter_files())
+        for filename in list(index):
+            if filename not in files:
+                del index[filename]
+        for filename in files.difference(index):
+            mtime = os.path.getmtime(os.path.join(self.path, filename))
+            index[filename] = self.make_entry(filename, mtime)
+        return index
+
+    def save_index(self, index):
+        fd, tmp = tempfile.mkstemp(prefix='.index-', dir=self.path)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+            f.write('\n')
+        os.rename(tmp, self.index_filename)
+
+    @contextmanager
+    def open_index(self):
+        """Loads the index and saves it back after the block.  Other
+        builds cannot open the index while the block runs.
+        """
+        with self._lock:
+            lock = self.lock_file(self.index_lock_filename)
+            try:
+                index = self.load_index()
+                yield index
+                self.save_index(index)
+            finally:
+                lock.close()
+
+    @contextmanager
+    def lease(self):
+        """Takes a lease on the cache while the block runs.  The lease is
+        a page of links to all files in the cache which pip can read
+        through ``--find-links``.  It yields the filename of that page and
+        the names of the files in it.  Files that are evicted while the
+        lease is held are only removed once the lease is released (see
+        :meth:`evict`) and builds that start later do not see them.
+        """
+        try:
+            os.makedirs(self.leases_path)
+        except OSError:
+            pass
+        while 1:
+            fd, lock_filename = tempfile.mkstemp(dir=self.leases_path,
+                                                 suffix='.lock')
+            lock = os.fdopen(fd, 'w')
+            lock_file(lock)
+            # A prune might have removed the lock file as a stale lease
+            # before it was locked.
+            try:
+                if os.stat(lock_filename).st_ino == os.fstat(fd).st_ino:
+                    break
+            except OSError:
+                pass
+            lock.close()
+        page = lock_filename[:-5] + '.html'
+        try:
+            with self._lock:
+                index_lock = self.lock_file(self.index_lock_filename)
+                try:
+                    index = self.load_index()
+                finally:
+                    index_lock.close()
+            filenames = sorted(x for x in index
+                               if 'evicted' not in index[x])
+            with open(page, 'w') as f:
+                for filename in filenames:
+                    url = 'file:' + urllib.pathname2url(
+                        os.path.join(self.path, filename))
+                    f.write('<a href="%s">%s</a>\n' % (
+                        cgi.escape(url, True), cgi.escape(filename)))
+            yield page, set(filenames)
+        finally:
+            for filename in page, lock_filename:
+                try:
+                    os.remove(filename)
+                except OSError:
+                    pass
+            lock.close()
+
+    def collect_leases(self):
+        """Removes the leases of builds that died and returns the names
+        of the leases that are still held.
+        """
+        rv = set()
+        # Without locks live leases cannot be told apart from dead ones.
+        if fcntl is None:
+            return rv
+        try:
+            filenames = os.listdir(self.leases_path)
+        except OSError:
+            return rv
+        for filename in filenames:
+            if not filename.endswith('.lock'):
+                continue
+            lock_filename = os.path.join(self.leases_path, filename)
+            try:
+                lock = self.lock_file(lock_filename, blocking=False)
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                rv.add(filename[:-5])
+                continue
+            # The lease might have been released while we looked at it
+            # in which case its files are already gone.
+            try:
+                for path in lock_filename[:-5] + '.html', lock_filename:
+                    if os.path.exists(path):
+                        os.remove(path)
+            except OSError:
+                pass
+            finally:
+                lock.close()
+        return rv
+
+    def add(self, index, filename, hardlink=False):
+        """Adds a file to the cache unless it is already there and marks
+        it as used.  If `hardlink` is set, the file may be hardlinked into
+        the cache (see :func:`link_file`).  Returns `True` if the file was
+        newly added.
+        """
+        basename = os.path.basename(filename)
+        entry = index.get(basename)
+        if entry is not None:
+            # A file that waits for its removal is still intact and can
+            # simply be kept.
+            entry.pop('evicted', None)
+            entry['last_used'] = time.time()
+            return False
+        # Readers must never see a partially written file, so it is
+        # placed under a temporary name first.
+        tmp = os.path.join(self.path, '.%s.%d-%d.tmp' % (
+            basename, os.getpid(), threading.current_thread().ident))
+        link_file(filename, tmp, hardlink=hardlink)
+        make_immutable(tmp)
+        os.rename(tmp, os.path.join(self.path, basename))
+        index[basename] = self.make_entry(basename)
+        return True
+
+    def remove(self, index, filename):
+        try:
+            os.remove(os.path.join(self.path, filename))
+        except OSError:
+            return False
+        del index[filename]
+        return True
+
+    def evict(self, index, max_size=None, older_than=None, leases=()):
+        """Removes the least recently used files until the cache is no
+        larger than `max_size` bytes and all files that were not used
+        within the last `older_than` seconds.  Files that are in one of
+        the given live `leases` are marked as evicted instead and only
+        removed by a later call once those leases are gone.  Returns the
+        names of the evicted files.
+        """
+        for filename in list(index):
+            pins = index[filename].get('evicted')
+            if pins is not None and not set(pins) & set(leases):
+                self.remove(index, filename)
+
+        rv = []
+        total = sum(x['size'] for x in index.values()
+                    if 'evicted' not in x)
+        now = time.time()
+        for filename in sorted(index, key=lambda x: index[x]['last_used']):
+            entry = index[filename]
+            if 'evicted' in entry:
+                continue
+            if not (older_than is not None and
+                    entry['last_used'] < now - older_than) and \
+               not (max_size is not None and total > max_size):
+                continue
+            if leases:
+                entry['evicted'] = sorted(leases)
+            elif not self.remove(index, filename):
+                continue
+            total -= entry['size']
+            rv.append(filename)
+        return rv
+
+    def prune(self, max_size=None, older_than=None):
+        """Evicts files (see :meth:`evict`) and removes the leases of
+        builds that died.
+        """
+        with self.open_index() as index:
+            return self.evict(index, max_size=max_size,
+                              older_than=older_than,
+                              leases=self.collect_leases())
+
+
 class Builder(object):
 
     def __init__(self, log, path, output, python=None,
                  virtualenv_version=None, wheel_version=None,
                  pip_options=None, no_download=None, wheel_cache=None,
-                 requirements=None):
+                 requirements=None, artifact_cache=None, force=False,
+                 jobs=1, compress_threads=1, compress_level=None,
+                 venv_pool=None, cache_max_size=None, artifact_tag=None,
+                 shared_venv=None, shared_wheelhouse=None,
+                 timings_json=None, prebuilt_venv=False, locked=False,
+                 metadata_cache=None, cancel_token=None, dedupe=False,
+                 isolate_source=False):
         self.log = log
         self.path = os.path.abspath(path)
         self.output = output
@@ -234,14 +1877,54 @@ class Builder(object):
         if requirements is not None:
             requirements = os.path.abspath(requirements)
         self.requirements = requirements
+        if artifact_cache is not None:
+            artifact_cache = os.path.abspath(artifact_cache)
+        self.artifact_cache = artifact_cache
+        self.force = force
+        self.jobs = max(1, jobs)
+        self.compress_threads = max(1, compress_threads)
+        self.compress_level = compress_level
         self.no_download = no_download
         self.pip_options = list(pip_options or ())
+        if venv_pool is not None:
+            venv_pool = os.path.abspath(venv_pool)
+        self.venv_pool = venv_pool
+        self.cache_max_size = cache_max_size
+        self.artifact_tag = artifact_tag
+        self.shared_venv = shared_venv
+        self.shared_wheelhouse = shared_wheelhouse
+        if timings_json is not None and artifact_tag is not None:
+            root, ext = os.path.splitext(timings_json)
+            timings_json = '%s-%s%s' % (root, artifact_tag, ext)
+        self.timings_json = timings_json
+        self.prebuilt_venv = prebuilt_venv
+        self.locked = locked
+        self.metadata_cache = metadata_cache
+        self.cancel_token = cancel_token
+        self.wheel_lease = None
+        self.wheel_lease_files = None
+        # Set for builds whose data folder nobody modifies in place and
+        # that is not the artifact itself, so it can share files with
+        # the cache through hardlinks.
+        self.hardlink_data = False
+        self.dedupe = dedupe
+        self.isolate_source = isolate_source
+        self.timings = BuildTimings()
         self.scratchpads = []
+        self.venv_locks = []
+        self._interpreter_info = None
+        self._source_digest = None
+        self._git_head = None
+        self._git_state = None
 
     def get_pip_options(self):
         rv = self.pip_options
-        if self.wheel_cache and os.path.isdir(self.wheel_cache):
+        if self.wheel_lease is not None:
+            rv = rv + ['-f', self.wheel_lease]
+        elif self.wheel_cache and os.path.isdir(self.wheel_cache):
             rv = rv + ['-f', self.wheel_cache]
+        if self.shared_wheelhouse is not None:
+            rv = rv + ['-f', self.shared_wheelhouse]
         if self.no_download:
             rv = rv + ['--no-index']
         return rv
@@ -258,25 +1941,129 @@ class Builder(object):
         self.log.info('Created scratchpad in {}', sp)
         return sp
 
+    def spawn(self, cmdline, **kwargs):
+        """Starts a process (by default in the project folder) that is
+        terminated if the build is cancelled before it was waited for.
+        """
+        kwargs.setdefault('cwd', self.path)
+        process = subprocess.Popen(cmdline, **kwargs)
+        if self.cancel_token is not None:
+            self.cancel_token.register(process)
+        return process
+
+    def wait(self, process, timing=None):
+        """Waits for a process started by :meth:`spawn`.  The resource
+        usage of the process is stored in the `timing` record if given.
+        """
+        try:
+            while 1:
+                try:
+                    status, usage = os.wait4(process.pid, 0)[1:]
+                    break
+                except OSError as e:
+                    if e.errno != errno.EINTR:
+                        raise
+            if os.WIFSIGNALED(status):
+                process.returncode = -os.WTERMSIG(status)
+            else:
+                process.returncode = os.WEXITSTATUS(status)
+            if timing is not None:
+                timing.update(user=usage.ru_utime, system=usage.ru_stime,
+                              max_rss_kb=usage.ru_maxrss)
+            return process.returncode
+        finally:
+            if self.cancel_token is not None:
+                self.cancel_token.unregister(process)
+
     def execute(self, cmd, args=None, capture=False):
         cmdline = [cmd]
         cmdline.extend(args or ())
         self.log.info('Executing {}', ' '.join(map(autoquote, cmdline)))
+        self.log.event('process_start', cmdline=cmdline)
+        start = time.time()
         with self.log.indented():
-            cl = subprocess.Popen(cmdline, cwd=self.path,
-                                  stdout=subprocess.PIPE,
-                                  stderr=subprocess.PIPE)
-            if capture:
-                rv = cl.communicate()[0]
-            else:
-                rv = None
-                self.log.process_stream_output(cl)
+            with self.timings.process(cmdline) as timing:
+                if capture:
+                    # communicate() would reap the process before its
+                    # resource usage can be read, so stderr is dropped.
+                    with open(os.devnull, 'wb') as devnull:
+                        cl = self.spawn(cmdline, stdout=subprocess.PIPE,
+                                        stderr=devnull)
+                    rv = cl.stdout.read()
+                    cl.stdout.close()
+                else:
+                    cl = self.spawn(cmdline, stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+                    rv = None
+                    self.log.process_stream_output(cl)
+                self.wait(cl, timing)
+            self.log.event('process_end', cmdline=cmdline,
+                           returncode=cl.returncode,
+                           wall=time.time() - start)
 
-            if cl.wait() != 0:
+            if cl.returncode != 0:
+                self.log.show_spooled_output()
                 self.log.error('Failed to execute command "%s"' % cmd)
                 raise click.Abort()
             return rv
 
+    def execute_parallel(self, jobs):
+        """Executes a list of ``(description, cmd, args)`` jobs in a pool
+        of workers.  The output of each job is collected separately and
+        logged once all jobs finished.  If one job fails all other jobs
+        are terminated and the build is aborted.
+        """
+        log_dir = self.make_scratchpad('logs')
+        lock = threading.Lock()
+        running = []
+        failed = []
+
+        def _run(args):
+            idx, (description, cmd, cmd_args) = args
+            log_fn = os.path.join(log_dir, '%d.log' % idx)
+            with open(log_fn, 'wb') as log_f:
+                with self.timings.process([cmd] + list(cmd_args)) as timing:
+                    with lock:
+                        if failed:
+                            return None
+                        c = self.spawn([cmd] + list(cmd_args),
+                                       stdout=log_f,
+                                       stderr=subprocess.STDOUT)
+                        running.append(c)
+                    rv = self.wait(c, timing)
+            with lock:
+                running.remove(c)
+                if rv != 0 and not failed:
+                    failed.append(description)
+                    for other in running:
+                        other.terminate()
+            return log_fn
+
+        self.log.info('Executing {} jobs with {} workers',
+                      len(jobs), self.jobs)
+        pool = ThreadPool(self.jobs)
+        try:
+            log_files = pool.map(_run, enumerate(jobs))
+        finally:
+            pool.close()
+            pool.join()
+
+        with self.log.indented():
+            for (description, cmd, cmd_args), log_fn in zip(jobs, log_files):
+                if log_fn is None or (self.log.quiet and
+                                      description not in failed):
+                    continue
+                self.log.info('Output of {}', description)
+                with self.log.indented():
+                    with open(log_fn) as f:
+                        for line in f:
+                            self.log.echo(click.style(line.rstrip(),
+                                                      fg='cyan'))
+
+        if failed:
+            self.log.error('Failed to execute job "%s"' % failed[0])
+            raise click.Abort()
+
     def cleanup(self):
         while self.scratchpads:
             sp = self.scratchpads.pop()
@@ -285,71 +2072,631 @@ class Builder(object):
                 shutil.rmtree(sp)
             except (OSError, IOError):
                 pass
+        while self.venv_locks:
+            self.venv_locks.pop().close()
+
+    @contextmanager
+    def phase(self, name):
+        """Marks a phase of the build for the timings and the log."""
+        if self.cancel_token is not None and self.cancel_token.cancelled:
+            self.log.error('The build was cancelled')
+            raise click.Abort()
+        self.log.event('phase_start', phase=name)
+        start = time.time()
+        with self.timings.phase(name):
+            yield
+        self.log.event('phase_end', phase=name, wall=time.time() - start)
+
+    def get_interpreter_info(self):
+        """Returns the path and version of the build interpreter."""
+        if self._interpreter_info is None:
+            self._interpreter_info = self.execute(self.python, [
+                '-c', 'import sys; print(sys.executable); print(sys.version)'],
+                capture=True)
+        return self._interpreter_info
+
+    def iter_source_files(self):
+        output = os.path.abspath(self.output)
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            # Only the build and dist folders of the project itself are
+            # build output, a package can have modules called like that.
+            dirnames[:] = sorted(
+                x for x in dirnames if x[:1] != '.' and
+                x != '__pycache__' and
+                (dirpath != self.path or x not in IGNORED_SOURCE_DIRS) and
+                not x.endswith('.egg-info') and
+                os.path.join(dirpath, x) != output)
+            # Symlinks to folders are not followed but the link itself
+            # is part of the source.
+            filenames = filenames + [x for x in dirnames if
+                                     os.path.islink(os.path.join(dirpath, x))]
+            for filename in sorted(filenames):
+                if filename[:1] != '.' and not is_lock_filename(filename) and \
+                   not filename.endswith(('.pyc', '.pyo')):
+                    yield os.path.join(dirpath, filename)
+
+    def get_source_digest(self):
+        """Returns a digest over the names and contents of all source
+        files of the project.  Symlinks contribute their target as well
+        and files that are neither regular files nor symlinks (or that
+        symlinks point to) are skipped.
+        """
+        if self._source_digest is None:
+            h = hashlib.sha256()
+            for filename in self.iter_source_files():
+                h.update(os.path.relpath(filename, self.path) + '\0')
+                if os.path.islink(filename):
+                    h.update('-> ' + os.readlink(filename) + '\0')
+                if os.path.isfile(filename):
+                    hash_file(filename, h)
+            self._source_digest = h.hexdigest()
+        return self._source_digest
+
+    def get_build_fingerprint(self, format, prebuild_script=None,
+                              postbuild_script=None):
+        """Calculates a fingerprint over all inputs of a build.  If two
+        builds have the same fingerprint they produce the same artifact
+        so the second one can be skipped.
+        """
+        h = hashlib.sha256()
+
+        def _add(value):
+            h.update(repr(value) + '\0')
+
+        def _add_file(filename):
+            _add(filename)
+            if filename is not None and os.path.isfile(filename):
+                hash_file(filename, h)
+
+        _add(self.get_interpreter_info())
+        _add(sysconfig.get_platform())
+        # The scripts and the layout of the artifact are defined by
+        # platter itself, so a new version of it must not reuse them.  The
+        # bytecode embeds the mtime of the source, so the source is used.
+        hash_file(re.sub(r'\.py[co]$', '.py', __file__), h)
+        _add((format, self.compress_level, self.virtualenv_version,
+              self.wheel_version, self.pip_options, self.no_download,
+              self.prebuilt_venv, self.locked, self.dedupe))
+        _add_file(self.requirements)
+        if self.locked:
+            _add_file(os.path.join(self.path, self.lock_filename))
+        _add_file(prebuild_script)
+        _add_file(postbuild_script)
+        _add(self.get_source_digest())
+        _add(self.get_git_head())
+        _add(self.get_git_state())
+        return h.hexdigest()
+
+    def find_memoized_artifact(self, fingerprint):
+        """Looks for an artifact that was built from the same inputs,
+        first in the output folder and then in the artifact cache.
+        """
+        if os.path.isdir(self.output):
+            for filename in os.listdir(self.output):
+                if not filename.endswith('.fingerprint'):
+                    continue
+                artifact = os.path.join(self.output, filename[:-12])
+                with open(os.path.join(self.output, filename)) as f:
+                    if f.read().strip() == fingerprint and \
+                       os.path.exists(artifact):
+                        return artifact
+
+        if self.artifact_cache is None:
+            return None
+        cache_dir = os.path.join(self.artifact_cache, fingerprint)
+        if not os.path.isdir(cache_dir):
+            return None
+        # Other builds might be storing the same artifact right now under
+        # a temporary name that starts with a dot.
+        artifacts = [x for x in os.listdir(cache_dir) if x[:1] != '.']
+        if not artifacts:
+            return None
+        basename = artifacts[0]
+        self.log.info('Copying {} from artifact cache', basename)
+        try:
+            os.makedirs(self.output)
+        except OSError:
+            pass
+        artifact = os.path.join(self.output, basename)
+        copy_artifact(os.path.join(cache_dir, basename), artifact)
+        self.memoize_artifact(artifact, fingerprint, cache=False)
+        return artifact
+
+    def memoize_artifact(self, artifact, fingerprint, cache=True):
+        with open(artifact + '.fingerprint', 'w') as f:
+            f.write(fingerprint + '\n')
+        if not cache or self.artifact_cache is None:
+            return
+        cache_dir = os.path.join(self.artifact_cache, fingerprint)
+        self.log.info('Storing artifact in artifact cache {}', cache_dir)
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            pass
+        cached = os.path.join(cache_dir, os.path.basename(artifact))
+        if not os.path.exists(cached):
+            copy_artifact(artifact, cached)
+
+    def get_git_head(self):
+        """Returns the commit that is checked out if the project is in a
+        git checkout (also one in a parent folder, a worktree or a
+        submodule), otherwise `None`.
+        """
+        if self._git_head is None:
+            try:
+                with open(os.devnull, 'wb') as devnull:
+                    self._git_head = subprocess.check_output(
+                        ['git', 'rev-parse', 'HEAD'],
+                        cwd=self.path, stderr=devnull).strip()
+            except (OSError, subprocess.CalledProcessError):
+                self._git_head = ''
+        return self._git_head or None
+
+    def get_git_state(self):
+        """Returns the tags that point at the checked out commit and if
+        the checkout has uncommitted changes, which is what versions
+        derived from git (for instance by setuptools_scm) depend on next
+        to the commit.  Returns `None` if the project is not in a git
+        checkout.
+        """
+        if self._git_state is None:
+            try:
+                with open(os.devnull, 'wb') as devnull:
+                    tags = subprocess.check_output(
+                        ['git', 'tag', '--points-at', 'HEAD'],
+                        cwd=self.path, stderr=devnull).split()
+                    changes = subprocess.check_output(
+                        ['git', 'status', '--porcelain',
+                         '--untracked-files=no'],
+                        cwd=self.path, stderr=devnull)
+                self._git_state = (sorted(tags), bool(changes.strip()))
+            except (OSError, subprocess.CalledProcessError):
+                self._git_state = False
+        return self._git_state or None
 
-    def describe_package(self, python):
-        # Do dummy invoke first to trigger setup requires.
-        self.log.info('Invoking dummy setup to trigger requirements.')
-        self.execute(python, ['setup.py', '--version'], capture=True)
+    def get_metadata_key(self):
+        # The version can depend on any file of the project (for instance
+        # a __version__ in the package) and on the state of the checkout.
+        h = hashlib.sha256()
+        h.update(self.get_source_digest() + '\0')
+        h.update(repr(self.get_git_head()) + '\0')
+        h.update(repr(self.get_git_state()))
+        return h.hexdigest()
 
-        rv = self.execute(python, [
-            'setup.py', '--name', '--version', '--fullname'],
-            capture=True).strip().splitlines()
-        platform = sysconfig.get_platform()
+    def make_pkginfo(self, name, version):
         return {
-            'name': rv[0],
-            'version': rv[1],
-            'platform': platform,
-            'ident': rv[2],
+            'name': name,
+            'version': version,
+            'platform': sysconfig.get_platform(),
+            'ident': '%s-%s' % (name, version),
         }
 
+    def find_package_metadata(self):
+        """Looks up the name and version of the package without running
+        the setup.py.  They are taken from the metadata cache (keyed by
+        the source files and the git commit) or from a ``PKG-INFO`` in
+        the project (as found in source distributions).  ``.egg-info``
+        folders are not trusted as they are left over from earlier builds
+        and can carry an outdated version.  Returns `None` if neither is
+        available.
+        """
+        key = self.get_metadata_key()
+        if self.metadata_cache is not None:
+            try:
+                with open(os.path.join(self.metadata_cache,
+                                       key + '.json')) as f:
+                    rv = json.load(f)
+                self.log.info('Using cached package metadata')
+                return self.make_pkginfo(rv['name'], rv['version'])
+            except (IOError, ValueError, KeyError):
+                pass
+
+        path = os.path.join(self.path, 'PKG-INFO')
+        if os.path.isfile(path):
+            with open(path) as f:
+                name, version = parse_metadata(f.read())
+            if name and version:
+                self.log.info('Using package metadata from {}', path)
+                return self.memoize_metadata(key, name, version)
+        return None
+
+    def memoize_metadata(self, key, name, version):
+        if self.metadata_cache is not None:
+            try:
+                os.makedirs(self.metadata_cache)
+            except OSError:
+                pass
+            fd, tmp = tempfile.mkstemp(dir=self.metadata_cache,
+                                       prefix='.metadata-')
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'name': name, 'version': version}, f)
+            os.rename(tmp, os.path.join(self.metadata_cache, key + '.json'))
+        return self.make_pkginfo(name, version)
+
+    def describe_wheel(self, filename):
+        """Reads the name and version of the package from its wheel."""
+        with zipfile.ZipFile(filename) as f:
+            for name in f.namelist():
+                if name.count('/') == 1 and \
+                   name.endswith('.dist-info/METADATA'):
+                    name, version = parse_metadata(f.read(name))
+                    break
+            else:
+                self.log.error('No metadata found in {}', filename)
+                raise click.Abort()
+        return self.memoize_metadata(self.get_metadata_key(), name, version)
+
+    def build_project_wheel(self, venv_path, project):
+        """Builds the wheel of the project alone so that its metadata is
+        known before the dependencies are built.
+        """
+        self.log.info('Building project wheel')
+        project_dir = self.make_scratchpad('project')
+        with self.log.indented():
+            self.execute(os.path.join(venv_path, 'bin', 'pip'),
+                         ['wheel', '--no-deps', '--wheel-dir=' + project_dir] +
+                         self.get_pip_options() + [project])
+        return os.path.join(project_dir, os.listdir(project_dir)[0])
+
+    def copy_source(self):
+        """Copies the project into a scratchpad.  setuptools writes its
+        build folders into the source tree, so concurrent builds of the
+        same project for other interpreters must not build from it.
+        """
+        self.log.info('Copying project source')
+        output = os.path.abspath(self.output)
+
+        def _ignore(dirpath, names):
+            return [x for x in names if x == '__pycache__' or
+                    x.endswith('.egg-info') or
+                    os.path.join(dirpath, x) == output or
+                    (dirpath == self.path and x in IGNORED_SOURCE_DIRS)]
+
+        rv = os.path.join(self.make_scratchpad('source'),
+                          os.path.basename(self.path))
+        shutil.copytree(self.path, rv, symlinks=True, ignore=_ignore)
+        return rv
+
     def copy_file(self, filename, target):
         if os.path.isdir(target):
             target = os.path.join(target, os.path.basename(filename))
-        shutil.copy2(filename, target)
+        if link_file(filename, target,
+                     hardlink=self.hardlink_data) != 'hardlink':
+            make_writable(target)
 
-    def place_venv_deps(self, venv_path, data_dir):
+    def place_venv_deps(self, venv_path, archive):
         self.log.info('Placing virtualenv dependencies')
-        self.copy_file(os.path.join(venv_path, 'virtualenv.py'),
-                       data_dir)
+        archive.add(os.path.join(venv_path, 'virtualenv.py'),
+                    'data/virtualenv.py')
 
         support_path = os.path.join(venv_path, 'virtualenv_support')
 
         for filename in os.listdir(support_path):
             if filename.endswith('.whl'):
-                self.copy_file(os.path.join(support_path, filename), data_dir)
+                archive.add(os.path.join(support_path, filename),
+                            'data/' + filename)
+
+    def build_wheels(self, venv_path, data_dir, project):
+        # The wheels are built into a folder of their own so that they
+        # can be told apart from the virtualenv dependencies no matter if
+        # the archive placed those in the data folder or not.
+        wheel_dir = self.make_scratchpad('wheels')
+        self._build_wheels(venv_path, wheel_dir, project)
+        wheels = sorted(os.listdir(wheel_dir))
+        for filename in wheels:
+            shutil.move(os.path.join(wheel_dir, filename),
+                        os.path.join(data_dir, filename))
+        self.put_wheel_list(data_dir, wheels)
+        return wheels
+
+    def put_wheels(self, data_dir, archive):
+        for filename in sorted(os.listdir(data_dir)):
+            path = os.path.join(data_dir, filename)
+            if os.path.isfile(path):
+                archive.add(path, 'data/' + filename)
 
-    def build_wheels(self, venv_path, data_dir):
+    def put_wheel_list(self, data_dir, filenames):
+        """Records the wheels that were built for the package together
+        with the script that can install them without pip.
+        """
+        with open(os.path.join(data_dir, 'wheels.txt'), 'w') as f:
+            for filename in sorted(filenames):
+                if filename.endswith('.whl'):
+                    f.write(filename + '\n')
+        with open(os.path.join(data_dir, 'fast_install.py'), 'w') as f:
+            f.write(FAST_INSTALLER)
+
+    def _build_wheels(self, venv_path, data_dir, project):
         self.log.info('Building wheels')
         pip = os.path.join(venv_path, 'bin', 'pip')
 
-        with self.log.indented():
-            self.execute(pip, ['download', '-d', data_dir] +
+        with self.log.indented():
+            if self.requirements is not None:
+                shutil.copy2(self.requirements,
+                             os.path.join(data_dir, 'requirements.txt'))
+
+            if self.locked:
+                self.build_wheels_locked(pip, data_dir, project)
+                return
+
+            self.execute(pip, ['download', '-d', data_dir] +
+                         self.get_pip_options() +
+                         [make_spec('wheel', self.wheel_version)])
+
+            cmdline = ['wheel', '--wheel-dir=' + data_dir]
+            cmdline.extend(self.get_pip_options())
+
+            if self.requirements is not None:
+                cmdline.extend(('-r', self.requirements))
+
+            if self.jobs > 1:
+                self.build_wheels_parallel(pip, data_dir, project)
+                return
+
+            cmdline.append(project)
+
+            self.execute(pip, cmdline)
+
+    @property
+    def lock_filename(self):
+        return get_lock_filename(self.artifact_tag)
+
+    def load_lock(self):
+        filename = os.path.join(self.path, self.lock_filename)
+        try:
+            with open(filename) as f:
+                return json.load(f)
+        except (IOError, ValueError) as e:
+            raise click.UsageError('Cannot use %s: %s' % (filename, e))
+
+    def put_lock(self, scratchpad, wheels, pkginfo, archive):
+        """Writes the exact wheels the dependencies were resolved to into
+        the artifact and, unless the build used the lock, next to the
+        project.  The wheel of the package itself is not locked.
+        """
+        data_dir = os.path.join(scratchpad, 'data')
+        key = re.sub(r'[-_.]+', '-', pkginfo['name']).lower()
+        entries = []
+        for filename in sorted(wheels):
+            if not filename.endswith('.whl'):
+                continue
+            name, version = parse_dist_filename(filename)
+            if re.sub(r'[-_.]+', '-', name).lower() == key:
+                continue
+            entries.append({
+                'name': name,
+                'version': version,
+                'filename': filename,
+                'sha256': hash_file(os.path.join(data_dir,
+                                                 filename)).hexdigest(),
+            })
+
+        fn = os.path.join(scratchpad, LOCK_FILENAME)
+        with open(fn, 'w') as f:
+            json.dump({'wheels': entries}, f, indent=2, sort_keys=True)
+            f.write('\n')
+        archive.add(fn, LOCK_FILENAME)
+        if not self.locked:
+            self.log.info('Writing {}', self.lock_filename)
+            copy_artifact(fn, os.path.join(self.path, self.lock_filename))
+
+    def build_wheels_locked(self, pip, data_dir, project):
+        """Places the wheels from the lock file without resolving the
+        dependencies again.  Wheels that are not in the wheel cache are
+        built from their pinned version.  Wheels that were built from
+        source distributions are not always reproducible, so only their
+        filename has to match.
+        """
+        lock = self.load_lock()
+        missing = []
+        for entry in lock['wheels']:
+            for folder in self.wheel_cache, self.shared_wheelhouse:
+                if folder is None:
+                    continue
+                # Only the files of our lease are safe to read from the
+                # cache, others might be about to be removed.
+                if folder == self.wheel_cache and \
+                   self.wheel_lease_files is not None and \
+                   entry['filename'] not in self.wheel_lease_files:
+                    continue
+                path = os.path.join(folder, entry['filename'])
+                if os.path.isfile(path) and \
+                   hash_file(path).hexdigest() == entry['sha256']:
+                    self.copy_file(path, data_dir)
+                    break
+            else:
+                missing.append(entry)
+
+        self.log.info('Using {} locked wheels from the cache',
+                      len(lock['wheels']) - len(missing))
+        if missing:
+            self.execute(pip, ['wheel', '--no-deps',
+                               '--wheel-dir=' + data_dir] +
                          self.get_pip_options() +
-                         [make_spec('wheel', self.wheel_version)])
+                         [make_spec(x['name'], x['version'])
+                          for x in missing])
+            for entry in missing:
+                if not os.path.isfile(os.path.join(data_dir,
+                                                   entry['filename'])):
+                    self.log.error('Locked wheel {} could not be built',
+                                   entry['filename'])
+                    raise click.Abort()
 
-            cmdline = ['wheel', '--wheel-dir=' + data_dir]
+        if project.endswith('.whl'):
+            self.copy_file(project, data_dir)
+        else:
+            self.execute(pip, ['wheel', '--no-deps',
+                               '--wheel-dir=' + data_dir] +
+                         self.get_pip_options() + [project])
+
+    def build_wheels_parallel(self, pip, data_dir, project):
+        """Resolves all dependencies first and then builds the wheels
+        for the source distributions in a pool of workers.
+        """
+        download_dir = self.make_scratchpad('downloads')
+        self.log.info('Resolving dependencies')
+        with self.log.indented():
+            cmdline = ['download', '-d', download_dir]
             cmdline.extend(self.get_pip_options())
+            if self.requirements is not None:
+                cmdline.extend(('-r', self.requirements))
+            cmdline.append(project)
+            self.execute(pip, cmdline)
+
+        jobs = []
+        if not project.endswith('.whl'):
+            jobs.append(('project', pip, ['wheel', '--no-deps',
+                                          '--wheel-dir=' + data_dir] +
+                         self.get_pip_options() + [project]))
+        for filename in sorted(os.listdir(download_dir)):
+            path = os.path.join(download_dir, filename)
+            if filename.endswith('.whl'):
+                self.copy_file(path, data_dir)
+            else:
+                jobs.append((filename, pip, ['wheel', '--no-deps',
+                                             '--wheel-dir=' + data_dir] +
+                             self.get_pip_options() + [path]))
+
+        self.log.info('Building wheels in parallel')
+        with self.log.indented():
+            self.execute_parallel(jobs)
 
+    def put_prebuilt_venv(self, virtualenv, scratchpad, data_dir, pkginfo,
+                          archive):
+        """Creates the final virtualenv inside the artifact and installs
+        the package into it.  The install script only has to copy it and
+        fix up the paths with the bundled relocation script.
+        """
+        self.log.info('Creating prebuilt virtualenv')
+        target = os.path.join(scratchpad, 'venv')
+        with self.log.indented():
+            self.execute(self.python,
+                         [os.path.join(virtualenv, 'virtualenv.py'), target])
+            cmdline = ['install', '--pre', '--no-index', '--no-compile',
+                       '--find-links', data_dir, 'wheel']
             if self.requirements is not None:
                 cmdline.extend(('-r', self.requirements))
-                shutil.copy2(self.requirements,
-                             os.path.join(data_dir, 'requirements.txt'))
+            cmdline.append(pkginfo['name'])
+            self.execute(os.path.join(target, 'bin', 'pip'), cmdline)
 
-            cmdline.append(self.path)
+        # Bytecode refers to the build location, the install script
+        # compiles the virtualenv again on the target host.
+        for dirpath, dirnames, filenames in os.walk(target):
+            if '__pycache__' in dirnames:
+                dirnames.remove('__pycache__')
+                shutil.rmtree(os.path.join(dirpath, '__pycache__'))
+            for filename in filenames:
+                if filename.endswith('.pyc'):
+                    os.remove(os.path.join(dirpath, filename))
 
-            self.execute(pip, cmdline)
+        with open(os.path.join(target, '.platter-prefix'), 'w') as f:
+            f.write(target + '\n')
+        with open(os.path.join(data_dir, 'relocate.py'), 'w') as f:
+            f.write(RELOCATOR)
+        archive.add(os.path.join(data_dir, 'relocate.py'), 'data/relocate.py')
 
     def setup_build_venv(self, virtualenv):
+        if self.venv_pool is not None:
+            return self.acquire_pooled_venv(virtualenv)
         scratchpad = self.make_scratchpad('venv')
         self.log.info('Initializing build virtualenv in {}', scratchpad)
+        self.create_build_venv(virtualenv, scratchpad)
+        return scratchpad
+
+    def create_build_venv(self, virtualenv, path):
         with self.log.indented():
             self.execute(self.python,
-                         [os.path.join(virtualenv, 'virtualenv.py'),
-                          scratchpad])
-            self.execute(os.path.join(scratchpad, 'bin', 'pip'),
+                         [os.path.join(virtualenv, 'virtualenv.py'), path])
+            self.execute(os.path.join(path, 'bin', 'pip'),
                          ['install'] + self.get_pip_options() +
                          [make_spec('wheel', self.wheel_version)])
-        return scratchpad
+
+    def acquire_pooled_venv(self, virtualenv):
+        """Picks a build virtualenv from the pool that is not used by
+        another build.  Virtualenvs are pooled by interpreter, virtualenv
+        and wheel version.  Each slot is protected by a lock file that is
+        held until the build is cleaned up.  If no wheel version is given,
+        reused virtualenvs upgrade wheel once a day (or on forced builds)
+        so that they pick up new releases like new ones.
+        """
+        h = hashlib.sha1(self.get_interpreter_info())
+        hash_file(os.path.join(virtualenv, 'virtualenv.py'), h)
+        h.update(repr(self.wheel_version))
+        base = os.path.join(self.venv_pool, h.hexdigest()[:16])
+        try:
+            os.makedirs(base)
+        except OSError:
+            pass
+
+        idx = 0
+        while 1:
+            lock = open(os.path.join(base, '%d.lock' % idx), 'a')
+            try:
+                lock_file(lock, blocking=False)
+            except IOError as e:
+                lock.close()
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                idx += 1
+                continue
+            self.venv_locks.append(lock)
+            break
+
+        path = os.path.join(base, str(idx))
+        pip = os.path.join(path, 'bin', 'pip')
+        baseline_fn = os.path.join(path, '.platter-baseline')
+        if os.path.isfile(baseline_fn):
+            self.log.info('Reusing build virtualenv in {}', path)
+            with open(baseline_fn) as f:
+                baseline = f.read().splitlines()
+            with self.log.indented():
+                self.reset_build_venv(path, baseline)
+                # The baseline is written when wheel was last upgraded.
+                if self.wheel_version is not None or (
+                        not self.force and
+                        os.path.getmtime(baseline_fn) >
+                        time.time() - VENV_POOL_REFRESH):
+                    return path
+                self.execute(pip, ['install', '--upgrade'] +
+                             self.get_pip_options() + ['wheel'])
+        else:
+            # Either the slot is new or the build that created it did not
+            # finish, in which case we start from scratch.
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            self.log.info('Initializing pooled build virtualenv in {}', path)
+            self.create_build_venv(virtualenv, path)
+        baseline = self.execute(pip, ['freeze', '--all'], capture=True)
+        with open(baseline_fn, 'w') as f:
+            f.write(baseline)
+        return path
+
+    def reset_build_venv(self, path, baseline):
+        """Brings a pooled virtualenv back to the set of packages it had
+        after it was created.
+        """
+        pip = os.path.join(path, 'bin', 'pip')
+        baseline = set(x.strip() for x in baseline if '==' in x)
+        wanted = dict(x.split('==', 1) for x in baseline)
+        current = self.execute(pip, ['freeze', '--all'],
+                               capture=True).splitlines()
+
+        uninstall = []
+        for line in current:
+            line = line.strip()
+            if not line or line.startswith('#') or line in baseline:
+                continue
+            name = line.split('==', 1)[0].split(' @ ', 1)[0]
+            if name.startswith('-e '):
+                name = name.rsplit('#egg=', 1)[-1]
+            if name not in wanted:
+                uninstall.append(name)
+        if uninstall:
+            self.execute(pip, ['uninstall', '-y'] + uninstall)
+
+        missing = sorted(baseline.difference(x.strip() for x in current))
+        if missing:
+            self.execute(pip, ['install'] + self.get_pip_options() + missing)
 
     def put_installer(self, scratchpad, pkginfo, install_script_path):
         fn = os.path.join(scratchpad, 'install.sh')
@@ -366,7 +2713,7 @@ class Builder(object):
             )).encode('utf-8'))
         os.chmod(fn, 0100755)
 
-    def put_meta_info(self, scratchpad, pkginfo):
+    def put_meta_info(self, scratchpad, pkginfo, archive):
         self.log.info('Placing meta information')
         with open(os.path.join(scratchpad, 'info.json'), 'w') as f:
             json.dump(pkginfo, f, indent=2)
@@ -377,57 +2724,115 @@ class Builder(object):
             f.write(pkginfo['platform'].encode('utf-8') + '\n')
         with open(os.path.join(scratchpad, 'PACKAGE'), 'w') as f:
             f.write(pkginfo['name'].encode('utf-8') + '\n')
+        for filename in 'info.json', 'VERSION', 'PLATFORM', 'PACKAGE':
+            archive.add(os.path.join(scratchpad, filename), filename)
+
+    def open_compressed_stream(self, fileobj, format):
+        if format == 'tar':
+            return fileobj
+        level = self.compress_level
+        if format == 'tar.gz' and self.compress_threads > 1:
+            return ParallelGzipFile(fileobj, self.compress_threads,
+                                    9 if level is None else level)
+        return CompressedFile(fileobj, make_compressor(
+            format, level, self.compress_threads))
 
-    def create_archive(self, scratchpad, pkginfo, format):
+    def create_archive(self, scratchpad, pkginfo, format, defer=False):
+        """Opens the archive for the artifact.  Files are streamed into
+        it while the build is running (unless `defer` is set) and the
+        artifact is finished by closing the returned
+        :class:`ArchiveWriter`.
+        """
         base = pkginfo['ident'] + '-' + pkginfo['platform']
+        if self.artifact_tag is not None:
+            base += '-' + self.artifact_tag
+        return self.open_archive(scratchpad, base, format, defer)
+
+    def open_archive(self, scratchpad, base, format, defer=False):
         try:
             os.makedirs(self.output)
         except OSError:
             pass
 
+        archive = ArchiveWriter(self, scratchpad, base, format, defer)
         if format == 'dir':
-            rv_fn = os.path.join(self.output, base)
-            self.log.info('Saving artifact as directory {}', rv_fn)
-            os.rename(scratchpad, rv_fn)
-            return rv_fn
+            self.log.info('Saving artifact as directory {}',
+                          archive.filename)
+        else:
+            self.log.info('Creating distribution archive {}',
+                          archive.filename)
+        return archive
 
-        archive_name = base + '.' + format
-        rv_fn = os.path.join(self.output, archive_name)
-        tmp_fn = os.path.join(self.output, '.' + archive_name)
+    def find_cached_virtualenv(self):
+        """Looks up an extracted virtualenv bootstrapper in the cache.
+        If the version is pinned, the cached copy of that version is used.
+        If downloading is disabled, the latest cached version is used.
+        """
+        if not self.wheel_cache:
+            return None
+        base = os.path.join(self.wheel_cache, 'virtualenv')
+        if not os.path.isdir(base):
+            return None
 
-        self.log.info('Creating distribution archive {}', rv_fn)
+        spec = self.virtualenv_version
+        if spec is not None and spec.startswith('=='):
+            spec = spec[2:]
+        if spec is not None and spec[:1] not in '<>=!~':
+            path = os.path.join(base, spec)
+            if os.path.isdir(path):
+                return path
+        elif self.no_download:
+            versions = [x for x in os.listdir(base) if x[:1] != '.']
+            if versions:
+                return os.path.join(base, max(versions, key=version_key))
+        return None
 
-        f = None
+    def cache_virtualenv(self, path, artifact):
+        """Stores an extracted virtualenv bootstrapper in the cache and
+        returns the path to the cached copy.
+        """
+        version = parse_dist_filename(artifact)[1]
+        base = os.path.join(self.wheel_cache, 'virtualenv')
+        rv = os.path.join(base, version)
+        if os.path.isdir(rv):
+            return rv
+        self.log.info('Caching virtualenv bootstrapper {}', version)
         try:
-            if format in ('tar.gz', 'tar.bz2', 'tar'):
-                if '.' in format:
-                    mode = 'w:' + format.split('.')[1]
-                else:
-                    mode = 'w'
-                f = tarfile.open(tmp_fn, mode)
-                f.add(scratchpad, base)
-                f.close()
-            elif format == 'zip':
-                f = zipfile.ZipFile(tmp_fn, 'w')
-                for dirpath, dirnames, files in os.walk(scratchpad):
-                    for file in files:
-                        f.write(os.path.join(dirpath, file),
-                                os.path.join(base, dirpath[
-                                    len(scratchpad) + 1:], file),
-                                zipfile.ZIP_DEFLATED)
-                f.close()
-            os.rename(tmp_fn, rv_fn)
+            os.makedirs(base)
+        except OSError:
+            pass
+        tmp = tempfile.mkdtemp(prefix='.' + version, dir=base)
+        try:
+            filenames = ['virtualenv.py']
+            os.mkdir(os.path.join(tmp, 'virtualenv_support'))
+            for filename in os.listdir(os.path.join(path,
+                                                    'virtualenv_support')):
+                filename = os.path.join('virtualenv_support', filename)
+                if os.path.isfile(os.path.join(path, filename)):
+                    filenames.append(filename)
+            for filename in filenames:
+                link_file(os.path.join(path, filename),
+                          os.path.join(tmp, filename), hardlink=True)
+                make_immutable(os.path.join(tmp, filename))
+            os.rename(tmp, rv)
+        except OSError:
+            # Another build might have cached the same version already.
+            if not os.path.isdir(rv):
+                raise
         finally:
-            if f is not None:
-                f.close()
-            try:
-                os.remove(tmp_fn)
-            except OSError:
-                pass
-
-        return rv_fn
+            if os.path.isdir(tmp):
+                shutil.rmtree(tmp)
+        return rv
 
     def extract_virtualenv(self):
+        if self.shared_venv is not None:
+            return self.shared_venv
+        cached = self.find_cached_virtualenv()
+        if cached is not None:
+            self.log.info('Using cached virtualenv bootstrapper from {}',
+                          cached)
+            return cached, None
+
         self.log.info('Downloading and extracting virtualenv bootstrapper')
         with self.log.indented():
             scratchpad = self.make_scratchpad('venv-tmp')
@@ -443,16 +2848,20 @@ class Builder(object):
             f.extractall(scratchpad)
             f.close()
 
-        # We need to detect if we contain a single artifact that is a
-        # folder in which case we need to use that.  Wheels for instance
-        # do not contain a wrapping folder.
-        artifacts = os.listdir(scratchpad)
-        if len(artifacts) == 1:
-            rv = os.path.join(scratchpad, artifacts[0])
-            if os.path.isdir(rv):
-                return rv, artifact
+            # We need to detect if we contain a single artifact that is a
+            # folder in which case we need to use that.  Wheels for instance
+            # do not contain a wrapping folder.
+            rv = scratchpad
+            artifacts = [x for x in os.listdir(scratchpad)
+                         if x != os.path.basename(artifact)]
+            if len(artifacts) == 1 and \
+               os.path.isdir(os.path.join(scratchpad, artifacts[0])):
+                rv = os.path.join(scratchpad, artifacts[0])
 
-        return scratchpad, artifact
+            if self.wheel_cache:
+                rv = self.cache_virtualenv(rv, artifact)
+
+        return rv, artifact
 
     def run_build_script(self, scratchpad, venv_path,
                          build_script, install_script_path):
@@ -474,27 +2883,84 @@ class Builder(object):
             }
             env = dict(os.environ)
             env['INSTALL_SCRIPT'] = install_script_path
-            c = subprocess.Popen(['sh'], env=env, stdin=subprocess.PIPE,
-                                 stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE,
-                                 cwd=scratchpad)
-            c.stdin.write(script)
-            c.stdin.flush()
-            c.stdin.close()
-            self.log.process_stream_output(c)
-            if c.wait() != 0:
+            with self.timings.process(['sh', build_script]) as timing:
+                c = self.spawn(['sh'], env=env,
+                               stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE,
+                               cwd=scratchpad)
+                c.stdin.write(script)
+                c.stdin.flush()
+                c.stdin.close()
+                self.log.process_stream_output(c)
+                self.wait(c, timing)
+            if c.returncode != 0:
+                self.log.show_spooled_output()
                 self.log.error('Build script failed :(')
                 raise click.Abort()
 
+    def build_shared_wheels(self, virtualenv, paths, wheelhouse):
+        """Resolves the dependencies of multiple packages together and
+        builds every wheel they need once into the wheelhouse.
+        """
+        venv_path = self.setup_build_venv(virtualenv)
+        pip = os.path.join(venv_path, 'bin', 'pip')
+        self.log.info('Building the wheels of {} packages', len(paths))
+        with self.log.indented():
+            cmdline = ['wheel', '--wheel-dir=' + wheelhouse]
+            cmdline.extend(self.get_pip_options())
+            if self.requirements is not None:
+                cmdline.extend(('-r', self.requirements))
+            with self.leasing_wheel_cache():
+                self.execute(pip, cmdline + list(paths))
+
+    @contextmanager
+    def leasing_wheel_cache(self):
+        """Makes pip read the wheel cache through a lease while the block
+        runs so that the wheels it picks cannot be evicted.
+        """
+        if not self.wheel_cache:
+            yield
+            return
+        with WheelCache(self.wheel_cache).lease() as (page, filenames):
+            self.wheel_lease = page
+            self.wheel_lease_files = filenames
+            try:
+                yield
+            finally:
+                self.wheel_lease = None
+                self.wheel_lease_files = None
+
+    def share_wheels(self, wheelhouse):
+        """Places the interpreter independent wheels into the shared
+        wheelhouse so that concurrent builds for other interpreters can
+        pick them up instead of downloading or building them again.
+        """
+        for filename in os.listdir(wheelhouse):
+            target = os.path.join(self.shared_wheelhouse, filename)
+            if not filename.endswith('-none-any.whl') or \
+               os.path.exists(target):
+                continue
+            tmp = os.path.join(self.shared_wheelhouse, '.%s.%d-%d.tmp' % (
+                filename, os.getpid(), threading.current_thread().ident))
+            link_file(os.path.join(wheelhouse, filename), tmp)
+            try:
+                os.rename(tmp, target)
+            except OSError:
+                # Another build published the same wheel first.
+                os.remove(tmp)
+                if not os.path.isfile(target):
+                    raise
+
     def update_wheel_cache(self, wheelhouse, venv_artifact):
         self.log.info('Updating wheel cache')
+        cache = WheelCache(self.wheel_cache)
 
-        def _place(filename):
-            basename = os.path.basename(filename)
-            if os.path.isfile(os.path.join(self.wheel_cache, basename)):
-                return
-            self.log.info('Caching {} for future use', basename)
-            shutil.copy2(filename, os.path.join(self.wheel_cache, basename))
+        filenames = [os.path.join(wheelhouse, x)
+                     for x in sorted(os.listdir(wheelhouse))
+                     if x[:1] != '.' and x.endswith('.whl')]
+        if venv_artifact is not None:
+            filenames.append(venv_artifact)
 
         with self.log.indented():
             try:
@@ -502,13 +2968,27 @@ class Builder(object):
             except OSError:
                 pass
 
-            for filename in os.listdir(wheelhouse):
-                if filename[:1] == '.' or not filename.endswith('.whl'):
-                    continue
-                _place(os.path.join(wheelhouse, filename))
-            _place(venv_artifact)
+            with cache.open_index() as index:
+                for filename in filenames:
+                    if cache.add(index, filename,
+                                 hardlink=self.hardlink_data):
+                        self.log.info('Caching {} for future use',
+                                      os.path.basename(filename))
+
+    def prune_wheel_cache(self):
+        self.log.info('Pruning wheel cache to {} bytes', self.cache_max_size)
+        cache = WheelCache(self.wheel_cache)
+        with self.log.indented():
+            for filename in cache.prune(max_size=self.cache_max_size):
+                self.log.info('Evicted {}', filename)
 
-    def finalize(self, artifact, time):
+    def finalize(self, artifact, time, digests=None):
+        self.log.event('build_end', artifact=artifact, total=time)
+        self.timings.report(self.log, time)
+        if self.timings_json is not None:
+            with open(self.timings_json, 'w') as f:
+                json.dump(self.timings.to_dict(time), f, indent=2)
+                f.write('\n')
         self.log.info('Done.')
         self.log.info('Total time elapsed: %.2fs' % time)
         self.log.info('Build artifact successfully created.')
@@ -517,17 +2997,105 @@ class Builder(object):
             if not os.path.isfile(artifact):
                 return
 
-            sha1 = hashlib.sha1()
-            md5 = hashlib.md5()
-            with open(artifact, 'rb') as f:
-                while 1:
-                    chunk = f.read(65536)
-                    if not chunk:
-                        break
-                    sha1.update(chunk)
-                    md5.update(chunk)
-            self.log.info('MD5: {}', md5.hexdigest())
-            self.log.info('SHA1: {}', sha1.hexdigest())
+            if not digests:
+                with open(artifact, 'rb') as f:
+                    hasher = HashingFile(f, ArchiveWriter.digest_algorithms)
+                    while hasher.read(65536):
+                        pass
+                digests = hasher.hexdigests()
+            self.log.info('MD5: {}', digests['md5'])
+            self.log.info('SHA1: {}', digests['sha1'])
+            self.log.info('SHA256: {}', digests['sha256'])
+
+    def load_artifact(self, artifact):
+        """Extracts an artifact and returns the path to the extracted
+        folder together with its ``info.json``.
+        """
+        self.log.info('Extracting {}', artifact)
+        path = extract_artifact(artifact, self.make_scratchpad('extract'))
+        try:
+            with open(os.path.join(path, 'info.json')) as f:
+                return path, json.load(f)
+        except (IOError, ValueError):
+            raise click.UsageError('%s is not a platter artifact' % artifact)
+
+    def build_delta(self, old, new, format):
+        """Creates an artifact that only contains the files of `new`
+        that differ from `old`, together with a script that rebuilds `new`
+        from an extracted copy of `old`.
+        """
+        now = time.time()
+        with self.phase('extract'):
+            old_path, old_info = self.load_artifact(old)
+            new_path, new_info = self.load_artifact(new)
+        if (old_info['name'], old_info['platform']) != \
+           (new_info['name'], new_info['platform']):
+            raise click.UsageError('Cannot create a delta from %s (%s) to '
+                                   '%s (%s)' % (old_info['ident'],
+                                                old_info['platform'],
+                                                new_info['ident'],
+                                                new_info['platform']))
+
+        scratchpad = self.make_scratchpad('delta')
+        files = {}
+        links = {}
+        self.log.info('Comparing {} to {}', old_info['ident'],
+                      new_info['ident'])
+        with self.phase('compare'), self.log.indented():
+            for path in iter_tree(new_path):
+                filename = os.path.join(new_path, path)
+                if os.path.islink(filename):
+                    links[path] = os.readlink(filename)
+                    continue
+                if not os.path.isfile(filename):
+                    raise click.UsageError('%s in %s is not a regular file'
+                                           % (path, new))
+                try:
+                    digest = hash_file(filename).hexdigest()
+                except IOError as e:
+                    raise click.UsageError('Cannot read %s in %s: %s'
+                                           % (path, new, e.strerror))
+                files[path] = [digest, stat.S_IMODE(os.stat(filename).st_mode)]
+                old_filename = os.path.join(old_path, path)
+                try:
+                    if os.path.isfile(old_filename) and \
+                       not os.path.islink(old_filename) and \
+                       hash_file(old_filename).hexdigest() == digest:
+                        continue
+                except IOError:
+                    pass
+                self.log.info('Adding {}', path)
+                target = os.path.join(scratchpad, 'files', path)
+                if not os.path.isdir(os.path.dirname(target)):
+                    os.makedirs(os.path.dirname(target))
+                link_file(filename, target)
+
+        with open(os.path.join(scratchpad, 'delta.json'), 'w') as f:
+            json.dump({'from': old_info, 'to': new_info, 'files': files,
+                       'links': links}, f, indent=2, sort_keys=True)
+            f.write('\n')
+        fn = os.path.join(scratchpad, 'apply_delta.py')
+        with open(fn, 'w') as f:
+            f.write(DELTA_APPLIER)
+        os.chmod(fn, 0100755)
+
+        base = '%s-delta-from-%s' % (os.path.basename(new_path),
+                                     old_info['version'])
+        archive = self.open_archive(scratchpad, base, format)
+        try:
+            with self.phase('create_archive'):
+                artifact = archive.close()
+        except BaseException:
+            archive.abort()
+            raise
+        if os.path.isfile(artifact) and os.path.isfile(new):
+            self.log.info('Delta size: {} bytes ({:.1f}% of {})',
+                          os.path.getsize(artifact),
+                          os.path.getsize(artifact) * 100.0 /
+                          (os.path.getsize(new) or 1),
+                          os.path.basename(new))
+        self.cleanup()
+        self.finalize(artifact, time.time() - now, archive.digests)
 
     def build(self, format, prebuild_script=None, postbuild_script=None):
         if not os.path.isdir(self.path):
@@ -535,44 +3103,598 @@ class Builder(object):
                                    % self.path)
 
         now = time.time()
-        venv_src, venv_artifact = self.extract_virtualenv()
-
-        venv_path = self.setup_build_venv(venv_src)
-        local_python = os.path.join(venv_path, 'bin', 'python')
-
-        self.log.info('Analyzing package')
-        pkginfo = self.describe_package(local_python)
-        with self.log.indented():
-            self.log.info('Name: {}', pkginfo['name'])
-            self.log.info('Version: {}', pkginfo['version'])
+        phase = self.phase
+        self.log.info('Calculating build fingerprint')
+        with phase('fingerprint'), self.log.indented():
+            fingerprint = self.get_build_fingerprint(
+                format, prebuild_script, postbuild_script)
+            self.log.info('Fingerprint: {}', fingerprint)
+            artifact = None
+            if not self.force:
+                artifact = self.find_memoized_artifact(fingerprint)
+        if artifact is not None:
+            self.log.info('Inputs are unchanged, reusing artifact')
+            self.finalize(artifact, time.time() - now)
+            return
 
         scratchpad = self.make_scratchpad('buildbase')
         data_dir = os.path.join(scratchpad, 'data')
         os.makedirs(data_dir)
+        self.hardlink_data = postbuild_script is None and format != 'dir'
 
-        install_script_path = os.path.join(venv_path, 'install_script')
+        install_script_path = os.path.join(
+            self.make_scratchpad('install-script'), 'install_script')
+        open(install_script_path, 'a').close()
 
-        self.place_venv_deps(venv_src, data_dir)
-        if prebuild_script is not None:
-            self.run_build_script(scratchpad, venv_path, prebuild_script,
-                                  install_script_path)
+        # The phases that add files to the archive depend on each other
+        # so that the archive is always written in the same order.
+        rv = {'pkginfo': self.find_package_metadata(), 'project': self.path}
+        scheduler = PhaseScheduler(self)
 
-        self.build_wheels(venv_path, data_dir)
-        self.put_meta_info(scratchpad, pkginfo)
-        open(install_script_path, 'a').close()
-        if postbuild_script is not None:
-            self.run_build_script(scratchpad, venv_path, postbuild_script,
-                                  install_script_path)
+        def _extract_virtualenv():
+            rv['venv_src'], rv['venv_artifact'] = self.extract_virtualenv()
+
+        def _setup_build_venv():
+            rv['venv_path'] = self.setup_build_venv(rv['venv_src'])
+
+        def _describe_package():
+            if rv['pkginfo'] is None:
+                rv['pkginfo'] = self.describe_wheel(rv['project'])
+            self.log.info('Analyzing package')
+            with self.log.indented():
+                self.log.info('Name: {}', rv['pkginfo']['name'])
+                self.log.info('Version: {}', rv['pkginfo']['version'])
 
+        def _copy_source():
+            rv['project'] = self.copy_source()
+
+        def _build_project_wheel():
+            rv['project'] = self.build_project_wheel(rv['venv_path'],
+                                                     rv['project'])
+
+        def _create_archive():
+            # The postbuild script can still change any file, so nothing
+            # is written to the archive before it finished.
+            rv['archive'] = self.create_archive(
+                scratchpad, rv['pkginfo'], format,
+                defer=postbuild_script is not None)
+
+        def _build_script(script):
+            return lambda: self.run_build_script(
+                scratchpad, rv['venv_path'], script, install_script_path)
+
+        def _build_wheels():
+            rv['wheels'] = self.build_wheels(rv['venv_path'], data_dir,
+                                             rv['project'])
+
+        def _put_lock():
+            self.put_lock(scratchpad, rv['wheels'], rv['pkginfo'],
+                          rv['archive'])
+
+        def _put_prebuilt_venv():
+            self.put_prebuilt_venv(rv['venv_src'], scratchpad, data_dir,
+                                   rv['pkginfo'], rv['archive'])
+
+        def _create_final_archive():
+            self.put_installer(scratchpad, rv['pkginfo'],
+                               install_script_path)
+            rv['artifact'] = rv['archive'].close()
+
+        add = scheduler.add
+        add('extract_virtualenv', _extract_virtualenv)
+        add('setup_build_venv', _setup_build_venv, ['extract_virtualenv'])
+        if rv['pkginfo'] is not None:
+            add('describe_package', _describe_package)
+        if prebuild_script is not None:
+            add('prebuild_script', _build_script(prebuild_script),
+                ['setup_build_venv', 'describe_package'])
+        if self.isolate_source:
+            add('copy_source', _copy_source, ['prebuild_script'])
+        if rv['pkginfo'] is None:
+            # The metadata is read from the wheel of the project.
+            add('build_project_wheel', _build_project_wheel,
+                ['setup_build_venv', 'prebuild_script', 'copy_source'])
+            add('describe_package', _describe_package,
+                ['build_project_wheel'])
+        add('open_archive', _create_archive, ['describe_package'])
+        add('place_venv_deps',
+            lambda: self.place_venv_deps(rv['venv_src'], rv['archive']),
+            ['extract_virtualenv', 'open_archive'])
+        # The bundled virtualenv wheels are placed first in every mode so
+        # that the archive is always written in the same order.
+        add('build_wheels', _build_wheels,
+            ['setup_build_venv', 'prebuild_script', 'copy_source',
+             'build_project_wheel', 'place_venv_deps'])
+        if self.shared_wheelhouse is not None:
+            add('share_wheels', lambda: self.share_wheels(data_dir),
+                ['build_wheels'])
+        add('put_wheels', lambda: self.put_wheels(data_dir, rv['archive']),
+            ['build_wheels', 'place_venv_deps'])
+        add('put_lock', _put_lock, ['put_wheels'])
+        if self.prebuilt_venv:
+            add('prebuilt_venv', _put_prebuilt_venv, ['put_lock'])
+        add('put_meta_info', lambda: self.put_meta_info(
+            scratchpad, rv['pkginfo'], rv['archive']),
+            ['put_lock', 'prebuilt_venv'])
+        if postbuild_script is not None:
+            add('postbuild_script', _build_script(postbuild_script),
+                ['put_meta_info'])
         if self.wheel_cache:
-            self.update_wheel_cache(data_dir, venv_artifact)
+            # The postbuild script may still replace wheels in the data
+            # folder, so they are cached once it finished.
+            add('update_wheel_cache', lambda: self.update_wheel_cache(
+                data_dir, rv['venv_artifact']),
+                ['build_wheels', 'postbuild_script'])
+        requires = ['put_meta_info', 'postbuild_script']
+        if format == 'dir':
+            # Closing the archive moves the folder with the wheels to the
+            # output, so everything else that reads them has to be done.
+            requires.extend(('share_wheels', 'update_wheel_cache'))
+        add('create_archive', _create_final_archive, requires)
 
-        self.put_installer(scratchpad, pkginfo,
-                           install_script_path)
-        artifact = self.create_archive(scratchpad, pkginfo, format)
+        try:
+            with self.leasing_wheel_cache():
+                scheduler.run()
+        except BaseException:
+            if 'archive' in rv:
+                rv['archive'].abort()
+            raise
+        artifact = rv['artifact']
+        archive = rv['archive']
+        self.memoize_artifact(artifact, fingerprint)
+        if self.wheel_cache and self.cache_max_size is not None:
+            with phase('prune_wheel_cache'):
+                self.prune_wheel_cache()
 
         self.cleanup()
-        self.finalize(artifact, time.time() - now)
+        self.finalize(artifact, time.time() - now, archive.digests)
+
+
+def build_matrix(log, path, output, pythons, format, prebuild_script=None,
+                 postbuild_script=None, **options):
+    """Builds the package for multiple interpreters at once.  The virtualenv
+    bootstrapper is only fetched once and the interpreter independent
+    wheels are built once into a common wheelhouse before the builds run
+    concurrently.  One artifact is created per interpreter.
+    """
+    errors = []
+    tags = get_interpreter_tags(pythons)
+
+    with Builder(log, path, output, python=pythons[0],
+                 **options) as shared:
+        options['shared_venv'] = shared.extract_virtualenv()
+        wheelhouse = shared.make_scratchpad('shared-wheels')
+        if not options['locked']:
+            try:
+                shared.build_shared_wheels(options['shared_venv'][0],
+                                           [shared.copy_source()],
+                                           wheelhouse)
+            except click.Abort:
+                log.info('Continuing without the shared wheels')
+            for filename in os.listdir(wheelhouse):
+                if not filename.endswith('-none-any.whl'):
+                    os.remove(os.path.join(wheelhouse, filename))
+
+        def _build(python, tag):
+            try:
+                # Every interpreter builds the project from its own copy
+                # as setuptools keeps its build folders in the source.
+                with Builder(log.child('[%s] ' % tag), path, output,
+                             python=python, artifact_tag=tag,
+                             shared_wheelhouse=wheelhouse,
+                             isolate_source=True, **options) as builder:
+                    builder.build(format, prebuild_script=prebuild_script,
+                                  postbuild_script=postbuild_script)
+            except Exception as e:
+                errors.append((python, e))
+
+        threads = []
+        for python, tag in zip(pythons, tags):
+            t = threading.Thread(target=_build, args=(python, tag))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+
+    for python, e in errors:
+        log.error('Build for {} failed: {}', python,
+                  e.__class__.__name__ if isinstance(e, click.Abort) else e)
+    if errors:
+        raise click.Abort()
+
+
+class BuildJob(object):
+    """A build that was submitted to the build daemon.  The output of the
+    build is written to the log file of the job and kept in memory until
+    the client that submitted it has followed along to the end.
+    """
+
+    def __init__(self, id, request, log_path):
+        self.id = id
+        self.request = request
+        self.log_path = log_path
+        self.state = 'queued'
+        self.token = CancelToken()
+        self.lines = []
+        self.detached = False
+        self._cond = threading.Condition()
+        self._log_file = open(log_path, 'wb')
+
+    @property
+    def done(self):
+        return self.state not in ('queued', 'running')
+
+    def write(self, line):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', 'replace')
+        with self._cond:
+            if self.lines is not None:
+                self.lines.append(line)
+            self._log_file.write(click.unstyle(line).encode('utf-8') + b'\n')
+            self._log_file.flush()
+            self._cond.notify_all()
+
+    def finish(self, state):
+        with self._cond:
+            self.state = state
+            self._log_file.close()
+            if self.detached:
+                self.lines = None
+            self._cond.notify_all()
+
+    def detach(self):
+        """Called when the client stopped following the job.  Once the
+        job is done its output is only kept in the log file.
+        """
+        with self._cond:
+            self.detached = True
+            if self.done:
+                self.lines = None
+
+    def wait_for_lines(self, offset, timeout):
+        """Waits until there are lines after `offset` or the job is done.
+        Returns the new lines and if the job is done.
+        """
+        with self._cond:
+            if len(self.lines) <= offset and not self.done:
+                self._cond.wait(timeout)
+            return self.lines[offset:], self.done
+
+    def to_dict(self):
+        return {
+            'job': self.id,
+            'state': self.state,
+            'path': self.request['path'],
+            'log': self.log_path,
+        }
+
+
+class JobLog(Log):
+    """Writes the log of a build into a job of the build daemon."""
+
+    def __init__(self, job, prefix=''):
+        Log.__init__(self, prefix=prefix,
+                     quiet=job.request.get('quiet', False))
+        self.job = job
+
+    def child(self, prefix):
+        return JobLog(self.job, prefix)
+
+    def echo(self, s):
+        self.job.write(self.prefix + '  ' * self.indentation + s)
+
+    def echo_lines(self, lines, color=None):
+        prefix = self.prefix + '  ' * self.indentation
+        for line in lines:
+            self.job.write(prefix + click.style(line.rstrip(), fg=color))
+
+
+class BuildRequestHandler(SocketServer.StreamRequestHandler):
+    """Handles one connection to the build daemon.  Every connection
+    sends a single request as JSON line and receives JSON lines back.
+    """
+
+    def send(self, **data):
+        self.wfile.write(json.dumps(data) + '\n')
+        self.wfile.flush()
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+        except ValueError:
+            self.send(event='error', message='Invalid request')
+            return
+        command = request.get('command')
+        if command == 'build':
+            self.follow(self.server.submit(request))
+        elif command == 'cancel':
+            self.send(event='result', ok=self.server.cancel(request['job']))
+        elif command == 'jobs':
+            self.send(event='jobs', jobs=self.server.list_jobs())
+        else:
+            self.send(event='error', message='Unknown command %r' % command)
+
+    def client_disconnected(self):
+        if not select.select([self.connection], [], [], 0)[0]:
+            return False
+        return not self.connection.recv(1)
+
+    def follow(self, job):
+        """Streams the output of a job to the client.  If the client goes
+        away before the job is done, the job is cancelled.
+        """
+        try:
+            self.send(event='queued', job=job.id, log=job.log_path)
+            offset = 0
+            while 1:
+                lines, done = job.wait_for_lines(offset, 0.5)
+                offset += len(lines)
+                for line in lines:
+                    self.send(event='output', line=line)
+                if done and not lines:
+                    break
+                if self.client_disconnected():
+                    self.server.cancel(job.id)
+                    return
+            self.send(event='result', job=job.id, state=job.state)
+        except socket.error:
+            self.server.cancel(job.id)
+        finally:
+            job.detach()
+
+    def finish(self):
+        try:
+            SocketServer.StreamRequestHandler.finish(self)
+        except socket.error:
+            # The client went away, its job was cancelled already.
+            pass
+
+
+# Unix sockets and with them the build daemon are not available on Windows.
+UnixStreamServer = getattr(SocketServer, 'UnixStreamServer',
+                           SocketServer.TCPServer)
+
+
+def check_daemon_support():
+    if not hasattr(socket, 'AF_UNIX'):
+        raise click.UsageError('The build daemon is not supported on this '
+                               'platform.')
+
+
+class BuildServer(SocketServer.ThreadingMixIn, UnixStreamServer):
+    """The build daemon.  It accepts jobs on a Unix socket and builds them
+    in a bounded pool of workers.  Extracted virtualenv bootstrappers are
+    kept for the lifetime of the daemon and shared by all jobs.  Only the
+    most recent finished jobs are remembered.
+    """
+
+    daemon_threads = True
+    max_finished_jobs = 100
+
+    def __init__(self, log, path, log_dir, workers=2):
+        UnixStreamServer.__init__(self, path, BuildRequestHandler)
+        self.log = log
+        self.log_dir = log_dir
+        self.pool = ThreadPool(max(1, workers))
+        self.jobs = {}
+        self.bootstrappers = {}
+        self._builders = []
+        self._lock = threading.Lock()
+        self._bootstrap_lock = threading.Lock()
+        self._next_id = 1
+
+    def server_bind(self):
+        # Whoever can connect can run build scripts as the user of the
+        # daemon, so the socket is only accessible to that user.  The
+        # umask keeps the socket private from the moment it exists.
+        old_umask = os.umask(0177)
+        try:
+            UnixStreamServer.server_bind(self)
+        finally:
+            os.umask(old_umask)
+        os.chmod(self.server_address, 0600)
+
+    def submit(self, request):
+        with self._lock:
+            job_id = self._next_id
+            self._next_id += 1
+            log_path = os.path.join(self.log_dir, '%s-%d.log' % (
+                time.strftime('%Y%m%d-%H%M%S'), job_id))
+            job = self.jobs[job_id] = BuildJob(job_id, request, log_path)
+        self.log.info('Queued job {} for {}', job_id, request['path'])
+        self.pool.apply_async(self.run_job, (job,))
+        return job
+
+    def cancel(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None or job.done:
+            return False
+        self.log.info('Cancelling job {}', job_id)
+        job.token.cancel()
+        return True
+
+    def expire_jobs(self):
+        with self._lock:
+            finished = sorted(x for x, job in self.jobs.items() if job.done)
+            for job_id in finished[:-self.max_finished_jobs]:
+                del self.jobs[job_id]
+
+    def list_jobs(self):
+        with self._lock:
+            return [self.jobs[x].to_dict() for x in sorted(self.jobs)]
+
+    def get_bootstrapper(self, options):
+        """Returns the virtualenv bootstrapper for the options of a job.
+        It is only extracted for the first job that needs it.
+        """
+        key = json.dumps([options.get(x) for x in (
+            'virtualenv_version', 'pip_options', 'no_download',
+            'wheel_cache')])
+        with self._bootstrap_lock:
+            rv = self.bootstrappers.get(key)
+            if rv is None:
+                builder = Builder(self.log, '.', '.', **options)
+                self._builders.append(builder)
+                rv = self.bootstrappers[key] = builder.extract_virtualenv()
+            return rv
+
+    def run_job(self, job):
+        if job.token.cancelled:
+            job.finish('cancelled')
+            self.log.info('Job {} cancelled', job.id)
+            self.expire_jobs()
+            return
+        job.state = 'running'
+        self.log.info('Running job {}', job.id)
+        request = job.request
+        log = JobLog(job)
+        pythons = request['python']
+        state = 'failed'
+        try:
+            options = dict(request['options'], cancel_token=job.token,
+                           shared_venv=self.get_bootstrapper(
+                               request['options']))
+            if len(pythons) > 1:
+                build_matrix(log, request['path'], request['output'],
+                             pythons, request['format'],
+                             prebuild_script=request['prebuild_script'],
+                             postbuild_script=request['postbuild_script'],
+                             **options)
+            else:
+                with Builder(log, request['path'], request['output'],
+                             python=pythons and pythons[0] or None,
+                             **options) as builder:
+                    builder.build(request['format'],
+                                  prebuild_script=request['prebuild_script'],
+                                  postbuild_script=request['postbuild_script'])
+            state = 'done'
+        except click.ClickException as e:
+            log.error('{}', e.format_message())
+        except click.Abort:
+            pass
+        except Exception:
+            for line in traceback.format_exc().splitlines():
+                log.echo(line)
+        if state != 'done' and job.token.cancelled:
+            state = 'cancelled'
+        job.finish(state)
+        self.log.info('Job {} {}', job.id, state)
+        self.expire_jobs()
+
+    def server_close(self):
+        with self._lock:
+            jobs = list(self.jobs.values())
+        for job in jobs:
+            job.token.cancel()
+        self.pool.close()
+        self.pool.join()
+        while self._builders:
+            self._builders.pop().cleanup()
+        UnixStreamServer.server_close(self)
+
+
+def build_with_daemon(log, socket_path, request):
+    """Submits a build to the build daemon and shows its output.  If the
+    client is interrupted, the daemon cancels the build.
+    """
+    check_daemon_support()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except socket.error as e:
+        sock.close()
+        raise click.UsageError('Cannot connect to the build daemon on %s '
+                               '(%s).  Start it with `platter serve`.'
+                               % (socket_path, e))
+    state = None
+    try:
+        sock.sendall(json.dumps(request) + '\n')
+        for line in sock.makefile('rb'):
+            msg = json.loads(line)
+            if msg['event'] == 'queued':
+                log.info('Submitted job {} to the build daemon (log in {})',
+                         msg['job'], msg['log'])
+            elif msg['event'] == 'output':
+                click.echo(msg['line'])
+            elif msg['event'] == 'result':
+                state = msg['state']
+    finally:
+        sock.close()
+    if state != 'done':
+        log.error('The build daemon reported the job as {}',
+                  state or 'lost')
+        raise click.Abort()
+
+
+def build_many(log, paths, output, format, python=None, workers=4,
+               prebuild_script=None, postbuild_script=None, **options):
+    """Builds multiple packages at once.  Packages whose inputs did not
+    change are skipped.  The dependencies of all other packages are
+    resolved in a single pip run that builds every wheel once into a
+    common wheelhouse.  The packages are then built concurrently and pick
+    their wheels up from there.  One artifact is created per package.
+    """
+    errors = []
+
+    def _is_unchanged(path):
+        with Builder(log, path, output, python=python, **options) as builder:
+            fingerprint = builder.get_build_fingerprint(
+                format, prebuild_script, postbuild_script)
+            artifact = builder.find_memoized_artifact(fingerprint)
+        if artifact is None:
+            return False
+        log.info('Reusing {} for {}', artifact, path)
+        return True
+
+    def _build(path):
+        name = os.path.basename(path)
+        project_options = dict(options)
+        if options['timings_json'] is not None:
+            root, ext = os.path.splitext(options['timings_json'])
+            project_options['timings_json'] = '%s-%s%s' % (root, name, ext)
+        try:
+            with Builder(log.child('[%s] ' % name), path, output,
+                         python=python, shared_wheelhouse=wheelhouse,
+                         **project_options) as builder:
+                builder.build(format, prebuild_script=prebuild_script,
+                              postbuild_script=postbuild_script)
+        except Exception as e:
+            errors.append((path, e))
+
+    changed = paths
+    if not options['force']:
+        log.info('Looking for unchanged packages')
+        with log.indented():
+            changed = [x for x in paths if not _is_unchanged(x)]
+        if not changed:
+            log.info('All packages are unchanged')
+            return
+
+    with Builder(log, paths[0], output, python=python, **options) as shared:
+        wheelhouse = shared.make_scratchpad('shared-wheels')
+        if changed and not options['locked']:
+            options['shared_venv'] = shared.extract_virtualenv()
+            try:
+                shared.build_shared_wheels(options['shared_venv'][0],
+                                           changed, wheelhouse)
+            except click.Abort:
+                # A package might only build after its prebuild script
+                # ran, so the packages still get a chance on their own.
+                log.info('Continuing without the shared wheels')
+
+        pool = ThreadPool(max(1, workers))
+        try:
+            pool.map(_build, changed)
+        finally:
+            pool.close()
+            pool.join()
+
+    for path, e in errors:
+        log.error('Build of {} failed: {}', path,
+                  e.__class__.__name__ if isinstance(e, click.Abort) else e)
+    if errors:
+        raise click.Abort()
 
 
 @click.group(context_settings={
@@ -595,56 +3717,177 @@ def cli():
     """
 
 
+BUILD_OPTIONS = [
+    click.option('--virtualenv-version', help='The version of virtualenv to '
+                 'use.  The default is to use the latest stable version from '
+                 'PyPI.', metavar='SPEC'),
+    click.option('--pip-option', multiple=True, help='Adds an option to '
+                 'pip.  To add multiple options, use this parameter multiple '
+                 'times.  Example:  --pip-option="--isolated"',
+                 type=click.Path(), metavar='OPT'),
+    click.option('--wheel-version', help='The version of the wheel package '
+                 'that should be used.  Defaults to latest stable from PyPI.',
+                 metavar='SPEC'),
+    click.option('--format', default='tar.gz', type=click.Choice(FORMATS),
+                 help='The format of the resulting build artifact as file '
+                 'extension.  Supported formats: ' + ', '.join(FORMATS),
+                 show_default=True, metavar='EXTENSION'),
+    click.option('--prebuild-script', type=click.Path(),
+                 help='Path to an optional build script that is invoked in '
+                 'the build folder as first step.  This can be used to '
+                 'install build dependencies such as Cython.'),
+    click.option('--postbuild-script', type=click.Path(),
+                 help='Path to an optional build script that is invoked in '
+                 'the build folder as last step.  This can be used to inject '
+                 'additional data into the archive.'),
+    click.option('--wheel-cache', type=click.Path(),
+                 help='An optional folder where platter should cache wheels '
+                 'instead of the system default.  If you do not want to use '
+                 'a wheel cache you can pass the --no-wheel-cache flag.'),
+    click.option('--no-wheel-cache', is_flag=True,
+                 help='Disables the wheel cache entirely.'),
+    click.option('--no-download', is_flag=True,
+                 help='Disables the downloading of all dependencies entirely. '
+                 'This will only work if all dependencies have been '
+                 'previously cached.  This is primarily useful when you are '
+                 'temporarily disconnected from the internet because it will '
+                 'disable useless network roundtrips.'),
+    click.option('-r', '--requirements', type=click.Path(),
+                 help='Optionally the path to a requirements file which '
+                 'contains additional packages that should be installed in '
+                 'addition to the main one.  This can be useful when you need '
+                 'to pull in optional dependencies.'),
+    click.option('--artifact-cache', type=click.Path(),
+                 help='An optional folder where finished build artifacts are '
+                 'stored by their build fingerprint.  If a build with the '
+                 'same inputs was done before, the artifact is copied from '
+                 'there instead of being built again.'),
+    click.option('--force', is_flag=True,
+                 help='Always build, even if an artifact built from the same '
+                 'inputs already exists.'),
+    click.option('-j', '--jobs', type=int, default=1,
+                 help='The number of wheels to build in parallel.  If this is '
+                 'larger than one, all dependencies are resolved first and '
+                 'the missing wheels are then built in a pool of workers.',
+                 show_default=True),
+    click.option('--compress-threads', type=int, default=1,
+                 help='The number of threads used to compress tar.gz and '
+                 'tar.zst artifacts.  The resulting archive is a regular '
+                 'gzip or zstandard file.', show_default=True),
+    click.option('--compress-level', type=int,
+                 help='The compression level for tar based formats.  Higher '
+                 'levels produce smaller archives but take longer to build.  '
+                 'The defaults are 9 for gzip and bzip2, 6 for xz and 3 for '
+                 'zstandard.  The valid range depends on the format: 1-9 '
+                 'for gzip and bzip2, 0-9 for xz and 1-22 for zstandard.',
+                 metavar='LEVEL'),
+    click.option('--venv-pool', type=click.Path(),
+                 help='An optional folder where platter keeps build '
+                 'virtualenvs for reuse instead of the system default.'),
+    click.option('--no-venv-pool', is_flag=True,
+                 help='Creates a new build virtualenv for every build.'),
+    click.option('--cache-max-size', callback=parse_size, metavar='SIZE',
+                 help='The maximum size of the wheel cache (for instance '
+                 '10G).  After the build the least recently used wheels are '
+                 'removed until the cache fits.'),
+    click.option('--timings-json', type=click.Path(),
+                 help='Writes the duration of all build phases and the '
+                 'resource usage of all executed processes as JSON to the '
+                 'given file.'),
+    click.option('-q', '--quiet', is_flag=True,
+                 help='Hides the output of pip and the build scripts unless '
+                 'they fail.'),
+    click.option('--log-events', type=click.File('w'),
+                 help='Writes all log messages and the progress of the build '
+                 'as JSON lines to the given file.'),
+    click.option('--prebuilt-venv', is_flag=True,
+                 help='Creates the final virtualenv at build time and places '
+                 'it in the artifact.  The install script then only copies it '
+                 'and fixes up its paths.  The target hosts need the same '
+                 'interpreter in the same location.'),
+    click.option('--locked', is_flag=True,
+                 help='Uses the exact wheels from the platter.lock of a '
+                 'previous build instead of resolving the dependencies.'),
+    click.option('--dedupe', is_flag=True,
+                 help='Keeps the wheels of dir artifacts in a store in the '
+                 'output folder and hardlinks them into the artifacts so '
+                 'that every wheel is stored only once.'),
+]
+
+
+def build_options(f):
+    """Adds the options that are shared by the build commands."""
+    for option in reversed(BUILD_OPTIONS):
+        f = option(f)
+    return f
+
+
+def get_builder_options(log, format, pip_option, no_wheel_cache,
+                        no_venv_pool, **options):
+    """Validates the options of the build commands and returns the ones
+    that are passed on to the builder.
+    """
+    if no_wheel_cache:
+        if options['no_download']:
+            raise click.UsageError('--no-download and --no-cache cannot '
+                                   'be used together.')
+        options['wheel_cache'] = None
+    elif options['wheel_cache'] is None:
+        options['wheel_cache'] = get_default_wheel_cache()
+    if options['wheel_cache'] is not None:
+        log.info('Using wheel cache in {}', options['wheel_cache'])
+
+    if options['prebuilt_venv'] and format == 'zip':
+        raise click.UsageError('--prebuilt-venv cannot be used with the '
+                               'zip format.')
+    if options['dedupe'] and format != 'dir':
+        raise click.UsageError('--dedupe can only be used with the dir '
+                               'format.')
+    check_compress_level(format, options['compress_level'])
+
+    if no_venv_pool:
+        options['venv_pool'] = None
+    elif fcntl is None:
+        if options['venv_pool'] is not None:
+            raise click.UsageError('--venv-pool is not supported on this '
+                                   'platform.')
+    elif options['venv_pool'] is None:
+        options['venv_pool'] = get_default_venv_pool()
+
+    options['pip_options'] = list(pip_option)
+    options['metadata_cache'] = get_default_metadata_cache()
+    return options
+
+
+def check_lock_file(path, options, tags=(None,)):
+    if not options['locked']:
+        return
+    for tag in tags:
+        filename = get_lock_filename(tag)
+        if not os.path.isfile(os.path.join(path, filename)):
+            raise click.UsageError('--locked requires a %s next to the '
+                                   'setup.py of %s.' % (filename, path))
+
+
 @cli.command('build')
 @click.argument('path', required=False, type=click.Path())
 @click.option('--output', type=click.Path(), default='dist',
               help='The output folder', show_default=True)
-@click.option('-p', '--python', type=click.Path(),
+@click.option('-p', '--python', type=click.Path(), multiple=True,
               help='The python interpreter to use for building.  This '
               'interpreter is both used for compiling the packages and also '
-              'used as default in the generated install script.')
-@click.option('--virtualenv-version', help='The version of virtualenv to use. '
-              'The default is to use the latest stable version from PyPI.',
-              metavar='SPEC')
-@click.option('--pip-option', multiple=True, help='Adds an option to pip.  To '
-              'add multiple options, use this parameter multiple times.  '
-              'Example:  --pip-option="--isolated"',
-              type=click.Path(), metavar='OPT')
-@click.option('--wheel-version', help='The version of the wheel package '
-              'that should be used.  Defaults to latest stable from PyPI.',
-              metavar='SPEC')
-@click.option('--format', default='tar.gz', type=click.Choice(FORMATS),
-              help='The format of the resulting build artifact as file '
-              'extension.  Supported formats: ' + ', '.join(FORMATS),
-              show_default=True, metavar='EXTENSION')
-@click.option('--prebuild-script', type=click.Path(),
-              help='Path to an optional build script that is invoked in '
-              'the build folder as first step.  This can be used to install '
-              'build dependencies such as Cython.')
-@click.option('--postbuild-script', type=click.Path(),
-              help='Path to an optional build script that is invoked in '
-              'the build folder as last step.  This can be used to inject '
-              'additional data into the archive.')
-@click.option('--wheel-cache', type=click.Path(),
-              help='An optional folder where platter should cache wheels '
-              'instead of the system default.  If you do not want to use '
-              'a wheel cache you can pass the --no-wheel-cache flag.')
-@click.option('--no-wheel-cache', is_flag=True,
-              help='Disables the wheel cache entirely.')
-@click.option('--no-download', is_flag=True,
-              help='Disables the downloading of all dependencies entirely. '
-              'This will only work if all dependencies have been previously '
-              'cached.  This is primarily useful when you are temporarily '
-              'disconnected from the internet because it will disable useless '
-              'network roundtrips.')
-@click.option('-r', '--requirements', type=click.Path(),
-              help='Optionally the path to a requirements file which contains '
-              'additional packages that should be installed in addition to '
-              'the main one.  This can be useful when you need to pull in '
-              'optional dependencies.')
-def build_cmd(path, output, python, virtualenv_version, wheel_version,
-              format, pip_option, prebuild_script, postbuild_script,
-              wheel_cache, no_wheel_cache, no_download, requirements):
+              'used as default in the generated install script.  If given '
+              'multiple times, one artifact is built for each interpreter.')
+@build_options
+@click.option('--daemon', is_flag=True,
+              help='Submits the build to a running build daemon (see '
+              '`platter serve`) instead of building in this process.')
+@click.option('--daemon-socket', type=click.Path(),
+              help='The socket of the build daemon.  Defaults to '
+              'daemon.sock in the platter cache folder.')
+def build_cmd(path, output, python, format, prebuild_script,
+              postbuild_script, quiet, log_events, daemon, daemon_socket,
+              **options):
     """Builds a platter package.  The argument is the path to the package.
     If not given it discovers the closest setup.py.
 
@@ -654,50 +3897,228 @@ def build_cmd(path, output, python, virtualenv_version, wheel_version,
     archived.  Optionally a post build script can be provided that can place
     more files in the archive and also provide more install steps.
     """
-    log = Log()
+    log = Log(quiet=quiet, events=log_events)
     if path is None:
         path = find_closest_package()
     log.info('Using package from {}', path)
 
-    if no_wheel_cache:
-        if no_download:
-            raise click.UsageError('--no-download and --no-cache cannot '
-                                   'be used together.')
-        wheel_cache = None
-    elif wheel_cache is None:
-        wheel_cache = get_default_wheel_cache()
-    if wheel_cache is not None:
-        log.info('Using wheel cache in {}', wheel_cache)
-
-    with Builder(log, path, output, python=python,
-                 virtualenv_version=virtualenv_version,
-                 wheel_version=wheel_version,
-                 pip_options=list(pip_option),
-                 no_download=no_download,
-                 wheel_cache=wheel_cache,
-                 requirements=requirements) as builder:
+    options = get_builder_options(log, format, **options)
+    if len(python) > 1:
+        check_lock_file(path, options, get_interpreter_tags(python))
+    else:
+        check_lock_file(path, options)
+
+    if daemon:
+        if log_events is not None:
+            raise click.UsageError('--log-events cannot be used with '
+                                   '--daemon.')
+        # The daemon runs in a different folder, so all paths it gets
+        # need to be absolute.
+        for key in ('wheel_cache', 'requirements', 'artifact_cache',
+                    'venv_pool', 'timings_json'):
+            if options[key] is not None:
+                options[key] = os.path.abspath(options[key])
+        build_with_daemon(log, daemon_socket or get_default_daemon_socket(), {
+            'command': 'build',
+            'path': os.path.abspath(path),
+            'output': os.path.abspath(output),
+            'python': [os.sep in x and os.path.abspath(x) or x
+                       for x in python],
+            'format': format,
+            'prebuild_script': prebuild_script and
+            os.path.abspath(prebuild_script),
+            'postbuild_script': postbuild_script and
+            os.path.abspath(postbuild_script),
+            'quiet': quiet,
+            'options': options,
+        })
+        return
+
+    if len(python) > 1:
+        build_matrix(log, path, output, python, format,
+                     prebuild_script=prebuild_script,
+                     postbuild_script=postbuild_script, **options)
+        return
+
+    with Builder(log, path, output, python=python and python[0] or None,
+                 **options) as builder:
         builder.build(format, prebuild_script=prebuild_script,
                       postbuild_script=postbuild_script)
 
 
+@cli.command('build-many')
+@click.argument('paths', nargs=-1, required=True)
+@click.option('--output', type=click.Path(), default='dist',
+              help='The output folder', show_default=True)
+@click.option('-p', '--python', type=click.Path(),
+              help='The python interpreter to use for building.  This '
+              'interpreter is both used for compiling the packages and also '
+              'used as default in the generated install scripts.')
+@click.option('--workers', type=int, default=4, show_default=True,
+              help='The number of packages that are built at the same time.')
+@build_options
+def build_many_cmd(paths, output, python, workers, format, prebuild_script,
+                   postbuild_script, quiet, log_events, **options):
+    """Builds multiple platter packages at once.  The arguments are the
+    paths to the packages or glob patterns that match them, for instance
+    the services of a monorepo:
+
+        $ platter build-many 'services/*'
+
+    The dependencies of all packages are resolved together and every
+    wheel is only built once.  The packages are then built concurrently
+    into the output folder, one artifact per package.
+    """
+    log = Log(quiet=quiet, events=log_events)
+    paths = find_projects(paths)
+    log.info('Building {} packages', len(paths))
+    with log.indented():
+        for path in paths:
+            log.info('{}', path)
+
+    options = get_builder_options(log, format, **options)
+    for path in paths:
+        check_lock_file(path, options)
+
+    build_many(log, paths, output, format, python=python, workers=workers,
+               prebuild_script=prebuild_script,
+               postbuild_script=postbuild_script, **options)
+
+
+@cli.command('delta')
+@click.argument('old', type=click.Path(exists=True))
+@click.argument('new', type=click.Path(exists=True))
+@click.option('--output', type=click.Path(), default='dist',
+              help='The output folder', show_default=True)
+@click.option('--format', default='tar.gz', type=click.Choice(FORMATS),
+              help='The format of the resulting delta.', show_default=True)
+@click.option('--compress-level', type=int,
+              help='The compression level for the delta.')
+def delta_cmd(old, new, output, format, compress_level):
+    """Creates a delta between two artifacts of the same package.
+
+    The delta only contains the files of the NEW artifact that changed
+    since the OLD artifact and is usually much smaller than NEW.  To get
+    the full NEW artifact on a host that has an extracted copy of OLD,
+    extract the delta and run the bundled script:
+
+        $ python apply_delta.py /path/to/OLD /path/to/NEW
+    """
+    check_compress_level(format, compress_level)
+    log = Log()
+    with Builder(log, '.', output,
+                 compress_level=compress_level) as builder:
+        builder.build_delta(old, new, format)
+
+
+@cli.command('serve')
+@click.option('--socket', 'socket_path', type=click.Path(),
+              help='The Unix socket to listen on.  Defaults to daemon.sock '
+              'in the platter cache folder.')
+@click.option('--workers', type=int, default=2, show_default=True,
+              help='The number of builds that run at the same time.  More '
+              'jobs are queued until a worker is free.')
+@click.option('--log-dir', type=click.Path(),
+              help='The folder for the logs of the jobs.  Defaults to the '
+              'jobs folder in the platter cache folder.')
+def serve_cmd(socket_path, workers, log_dir):
+    """Runs a build daemon.
+
+    The daemon accepts builds from `platter build --daemon` on a local
+    Unix socket and runs them in a pool of workers.  As it keeps running
+    between builds, the virtualenv bootstrapper is only extracted once
+    and the build virtualenvs in the pool stay warm.  The output of
+    every job goes to the client that submitted it and to a log file.
+    If the client is interrupted, the job is cancelled.
+    """
+    check_daemon_support()
+    log = Log()
+    if socket_path is None:
+        socket_path = get_default_daemon_socket()
+    if log_dir is None:
+        log_dir = get_default_job_log_dir()
+    for folder in os.path.dirname(os.path.abspath(socket_path)), log_dir:
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+    if os.path.exists(socket_path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+        except socket.error:
+            os.remove(socket_path)
+        else:
+            raise click.UsageError('A build daemon is already listening '
+                                   'on %s.' % socket_path)
+        finally:
+            probe.close()
+
+    server = BuildServer(log, socket_path, log_dir, workers=workers)
+    log.info('Listening on {} with {} workers', socket_path, workers)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        log.info('Shutting down')
+        server.server_close()
+        os.remove(socket_path)
+
+
+@cli.command('clean-store')
+@click.option('--output', type=click.Path(), default='dist',
+              help='The output folder', show_default=True)
+def clean_store_cmd(output):
+    """Removes unused wheels from the store of an output folder.
+
+    Builds with --dedupe keep the wheels of dir artifacts in a store in
+    the output folder and hardlink them into the artifacts.  Once the
+    artifacts that contain a wheel are deleted, this command removes the
+    wheel from the store as well.
+    """
+    log = Log()
+    store = os.path.join(output, STORE_FOLDER)
+    log.info('Cleaning store in {}', store)
+    with log.indented():
+        if os.path.isdir(store):
+            for path in collect_store_garbage(store):
+                log.info('Removed {}', os.path.basename(path))
+    log.info('Done')
+
+
 @cli.command('clean-cache')
-def clean_cache_cmd():
+@click.option('--older-than', callback=parse_duration, metavar='AGE',
+              help='Only remove wheels that were not used by a build '
+              'within the given time (for instance 12h or 30d).')
+@click.option('--max-size', callback=parse_size, metavar='SIZE',
+              help='Only remove the least recently used wheels until the '
+              'cache is no larger than the given size (for instance 10G).')
+def clean_cache_cmd(older_than, max_size):
     """This command cleans the wheel cache.
 
     This is useful when the cache got polluted with bad wheels due to a
     bug or if the cache grew too large.  Note that this only cleans the
     wheel cache, it does not clean the download cache of pip.
+
+    By default the entire cache is removed.  With --older-than and
+    --max-size only the wheels that were not used recently are removed.
+    Running builds keep reading removed wheels through their leases
+    until they finished.
     """
     log = Log()
     wheel_cache = get_default_wheel_cache()
     log.info('Cleaning cache in {}', wheel_cache)
     with log.indented():
         if os.path.isdir(wheel_cache):
-            for fn in os.listdir(wheel_cache):
-                if os.path.isfile(os.path.join(wheel_cache, fn)):
-                    try:
-                        log.info('Removing', fn)
-                        os.remove(os.path.join(wheel_cache, fn))
-                    except OSError:
-                        pass
+            if older_than is None and max_size is None:
+                older_than = 0
+            cache = WheelCache(wheel_cache)
+            removed = cache.prune(max_size=max_size, older_than=older_than)
+            for fn in removed:
+                log.info('Removed {}', fn)
+            leases = cache.collect_leases()
+            if leases:
+                log.info('{} running builds still hold removed wheels',
+                         len(leases))
     log.info('Done')